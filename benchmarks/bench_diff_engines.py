@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+
+# Compares the character and word diff engines on synthetic documents of
+# increasing length with scattered edits.
+#
+#   python3 benchmarks/bench_diff_engines.py [max_words [edits_per_1000_words]]
+#
+# Once an engine takes longer than a minute it is skipped for larger sizes.
+
+import os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.boxes import BoxStore
+from pdf_diff.command_line import normalize_boxes, perform_diff, perform_word_diff
+
+VOCABULARY = ["the", "court", "shall", "party", "agreement", "section", "notice", "any", "of", "to",
+              "provided", "that", "such", "in", "writing", "herein", "pursuant", "and", "or", "thereof"]
+
+def make_doc(pdf_index, words, seed):
+    rng = random.Random(seed)
+    return [rng.choice(VOCABULARY) for i in range(words)]
+
+def edit_doc(words, edits, seed):
+    rng = random.Random(seed)
+    words = list(words)
+    for i in range(edits):
+        pos = rng.randrange(len(words))
+        op = rng.choice(("insert", "delete", "replace"))
+        if op == "insert":
+            words.insert(pos, "inserted")
+        elif op == "delete":
+            del words[pos]
+        else:
+            words[pos] = "replaced"
+    return words
+
+def make_store(pdf_index, words):
+    boxes = BoxStore(pdf_index, "synthetic-%d.pdf" % pdf_index)
+    page = { "number": 1, "width": 612.0, "height": 792.0 }
+    for i, word in enumerate(words):
+        boxes.append({ "index": i, "page": page, "x": 0.0, "y": float(i), "width": 10.0, "height": 1.0, "text": word })
+    normalize_boxes(boxes)
+    return boxes
+
+def main():
+    max_words = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    edit_rate = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+    engines = [
+        ("char", lambda docs: perform_diff(docs[0].text, docs[1].text)),
+        ("word", lambda docs: perform_word_diff(docs[0], docs[1])),
+    ]
+    skip = set()
+    print("%10s %8s %12s %12s" % ("words", "edits", "char (s)", "word (s)"))
+    words = min(max_words, 12500)
+    while words <= max_words:
+        edits = max(1, int(words * edit_rate / 1000))
+        doc1 = make_doc(0, words, words)
+        docs = [make_store(0, doc1), make_store(1, edit_doc(doc1, edits, words))]
+        timings = []
+        for name, engine in engines:
+            if name in skip:
+                timings.append("skipped")
+                continue
+            t = time.perf_counter()
+            engine(docs)
+            t = time.perf_counter() - t
+            if t > 60:
+                skip.add(name)
+            timings.append("%.3f" % t)
+        print("%10d %8d %12s %12s" % (words, edits, timings[0], timings[1]))
+        words *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+
+# Compares the time and peak memory of rendering the changes between two
+# PDFs with full-color page images and with the low-memory grayscale
+# path. The changes are computed once up front and each rendering runs
+# in its own process so that its peak memory can be measured.
+#
+#   python3 benchmarks/bench_low_memory.py before.pdf after.pdf [width]
+
+import json, os, resource, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.command_line import compute_changes, render_changes
+
+def render(changes_fn, width, low_memory):
+    # Run in a child process: render and report seconds and peak RSS.
+    with open(changes_fn) as f:
+        changes = json.load(f)
+    t = time.perf_counter()
+    img = render_changes(changes, ["strike", "underline"], width, low_memory=low_memory)
+    t = time.perf_counter() - t
+    print(json.dumps({ "seconds": t, "maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "size": img.size }))
+
+def main():
+    if sys.argv[1] == "--render":
+        render(sys.argv[2], int(sys.argv[3]), sys.argv[4] == "1")
+        return
+
+    width = int(sys.argv[3]) if len(sys.argv) > 3 else 900
+    changes = compute_changes(sys.argv[1], sys.argv[2])
+    with tempfile.NamedTemporaryFile("w", suffix=".json") as f:
+        json.dump(changes, f)
+        f.flush()
+        print("%12s %10s %12s %14s" % ("mode", "seconds", "peak MB", "image"))
+        for mode, low_memory in (("color", "0"), ("low-memory", "1")):
+            result = json.loads(subprocess.check_output([sys.executable, __file__, "--render", f.name, str(width), low_memory]))
+            # ru_maxrss is in kilobytes on Linux but bytes on macOS.
+            peak = result["maxrss"] / (1024*1024 if sys.platform == "darwin" else 1024)
+            print("%12s %10.3f %12.1f %14s" % (mode, result["seconds"], peak, "%dx%d" % tuple(result["size"])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+# Times process_hunks on synthetic box lists of increasing size to check
+# that mapping diff hunks to boxes scales linearly.
+#
+#   python3 benchmarks/bench_process_hunks.py [max_words]
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.boxes import BoxStore
+from pdf_diff.command_line import normalize_box_text, process_hunks
+
+def make_boxes(pdf_index, words):
+    boxes = BoxStore(pdf_index, "synthetic-%d.pdf" % pdf_index)
+    page = { "number": 1, "width": 612.0, "height": 792.0 }
+    text = []
+    textlength = 0
+    for i in range(words):
+        boxes.append({ "index": i, "page": page, "x": 0.0, "y": float(i), "width": 10.0, "height": 1.0, "text": "word%d" % i })
+        normalized_text = normalize_box_text("word%d" % i)
+        boxes.startIndex.append(textlength)
+        boxes.textLength.append(len(normalized_text))
+        text.append(normalized_text)
+        textlength += len(normalized_text)
+    boxes.texts = None
+    boxes.text = "".join(text)
+    return boxes
+
+def make_hunks(boxes, change_every):
+    # Alternate runs of unchanged text with a replaced word every
+    # change_every words.
+    hunks = []
+    for row in range(len(boxes)):
+        if row % change_every == change_every - 1:
+            hunks += [("-", boxes.textLength[row]), ("+", boxes.textLength[row])]
+        else:
+            hunks.append(("=", boxes.textLength[row]))
+    return hunks
+
+def main():
+    max_words = int(sys.argv[1]) if len(sys.argv) > 1 else 800000
+    words = max_words // 16
+    print("%10s %10s %10s %12s" % ("words", "hunks", "seconds", "us/word"))
+    while words <= max_words:
+        boxes = [make_boxes(0, words), make_boxes(1, words)]
+        hunks = make_hunks(boxes[0], 10)
+        t = time.perf_counter()
+        process_hunks(hunks, boxes)
+        t = time.perf_counter() - t
+        print("%10d %10d %10.3f %12.3f" % (words, len(hunks), t, t / words * 1e6))
+        words *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+# Times realign_pages on synthetic change lists of increasing size, with
+# a "*" marker after every few changes as on a heavily edited document,
+# to check that finding the page splits and groups scales linearly.
+#
+#   python3 benchmarks/bench_realign_pages.py [max_changes]
+
+import os, random, sys, time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.command_line import realign_pages
+
+def make_changes(count, changes_per_page=40, page_height=1400):
+    # Changes on both documents move down their pages in step, with a
+    # marker after every few changes where the documents line up.
+    rng = random.Random(0)
+    pdfs = [{ "index": 0 }, { "index": 1 }]
+    changes = []
+    for i in range(count):
+        page = i // changes_per_page
+        y = (i % changes_per_page) * page_height / changes_per_page
+        changes.append({ "pdf": pdfs[i % 2], "page": page, "x": 10.0, "y": y + rng.uniform(0, 5), "width": 50.0, "height": 12.0 })
+        if rng.random() < .3:
+            changes.append("*")
+    return changes
+
+def make_pages(changes, width=8, page_height=1400):
+    # Tiny page images: the cost being measured is in the bookkeeping,
+    # not in cropping pixels.
+    pages = [{}, {}]
+    for change in changes:
+        if change == "*": continue
+        pages[change["pdf"]["index"]][change["page"]] = Image.new("L", (width, page_height))
+    return pages
+
+def main():
+    max_changes = int(sys.argv[1]) if len(sys.argv) > 1 else 64000
+    count = max_changes // 16
+    print("%10s %10s %10s %12s" % ("changes", "groups", "seconds", "us/change"))
+    while count <= max_changes:
+        changes = make_changes(count)
+        pages = make_pages(changes)
+        t = time.perf_counter()
+        page_groups = realign_pages(pages, changes)
+        t = time.perf_counter() - t
+        print("%10d %10d %10.3f %12.3f" % (len(changes), len(page_groups), t, t / len(changes) * 1e6))
+        count *= 2
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python3
+
+# Times compute_changes and render_changes, and measures their peak
+# memory, on synthetic pairs of PDFs (see synthetic.py) across numbers of
+# pages, words per page and edit densities. Each measurement runs in its
+# own process, and the best of --repeat runs is kept. The results are
+# written as JSON, and if a baseline (the results of an earlier run) is
+# given, any case that got slower or used more memory by more than the
+# thresholds is reported and the exit status is 1.
+#
+#   python3 benchmarks/bench_suite.py -o results.json [--pages 5,20,80] [--words 300] [--edits 0.001,0.01,0.1]
+#   python3 benchmarks/bench_suite.py -o new.json --baseline results.json [--time-threshold 0.1] [--memory-threshold 0.1]
+#   python3 benchmarks/bench_suite.py --compare new.json --baseline results.json
+
+import argparse, json, os, platform, subprocess, sys, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.profiling import Profiler
+from synthetic import make_pair
+
+def measure(kind, before_fn, after_fn, changes_fn, width):
+    # Run in a child process: compute the changes and write them to
+    # changes_fn, or render the changes read from it, and print the
+    # profile.
+    from pdf_diff.command_line import compute_changes, render_changes
+    if kind == "render":
+        with open(changes_fn) as f:
+            changes = json.load(f)
+    with Profiler() as profiler:
+        if kind == "compute":
+            changes = compute_changes(before_fn, after_fn)
+        else:
+            render_changes(changes, ["strike", "underline"], width)
+    if kind == "compute":
+        with open(changes_fn, "w") as f:
+            json.dump(changes, f)
+    print(json.dumps(profiler.report()))
+
+def run_case(case, corpus_dir, width, repeat):
+    name = case_name(case)
+    before_fn = os.path.join(corpus_dir, name + "-before.pdf")
+    after_fn = os.path.join(corpus_dir, name + "-after.pdf")
+    if not os.path.exists(after_fn):
+        make_pair(before_fn, after_fn, case["pages"], case["words"], case["edits"])
+
+    result = dict(case)
+    with tempfile.NamedTemporaryFile(suffix=".json") as changes_file:
+        for kind in ("compute", "render"):
+            if kind == "render" and result["counts"].get("changes", 0) == 0:
+                result[kind] = None # nothing to render
+                continue
+            reports = [json.loads(subprocess.check_output([sys.executable, os.path.abspath(__file__), "--measure", kind,
+                           before_fn, after_fn, changes_file.name, str(width)]))
+                       for i in range(repeat)]
+            best = min(reports, key=lambda report: report["total"]["wall"])
+            peak_rss = [report["total"]["peak_rss"] for report in reports if report["total"]["peak_rss"] is not None]
+            result[kind] = {
+                "seconds": best["total"]["wall"],
+                "cpu_seconds": best["total"]["cpu"],
+                "subprocess_cpu_seconds": best["total"]["subprocess_cpu"],
+                "peak_rss": min(peak_rss) if peak_rss else None,
+                "stages": { stage: entry["wall"] for stage, entry in best["stages"].items() },
+            }
+            if kind == "compute":
+                result["counts"] = best["counts"]
+    return result
+
+def case_name(case):
+    return "p%d-w%d-e%g" % (case["pages"], case["words"], case["edits"])
+
+# The measurements compared against a baseline, and which threshold
+# applies to them.
+METRICS = [
+    ("compute", "seconds", "time"),
+    ("compute", "peak_rss", "memory"),
+    ("render", "seconds", "time"),
+    ("render", "peak_rss", "memory"),
+]
+
+def compare(baseline, results, thresholds):
+    # Return a line for each measurement that grew by more than its
+    # threshold, as a fraction, over the baseline.
+    regressions = []
+    for name, result in sorted(results["cases"].items()):
+        if name not in baseline["cases"]:
+            continue
+        for kind, metric, threshold in METRICS:
+            old = (baseline["cases"][name].get(kind) or {}).get(metric)
+            new = (result.get(kind) or {}).get(metric)
+            if not old or new is None:
+                continue
+            if new > old * (1 + thresholds[threshold]):
+                regressions.append("%s %s %s: %.4g => %.4g (%+.1f%%, threshold %g%%)" % (
+                    name, kind, metric, old, new, 100.0 * (new - old) / old, 100.0 * thresholds[threshold]))
+    return regressions
+
+def print_results(results):
+    print("%-22s %8s %10s %10s %10s %10s" % ("case", "changes", "compute s", "compute MB", "render s", "render MB"))
+    for name, result in sorted(results["cases"].items(), key=lambda item: (item[1]["pages"], item[1]["words"], item[1]["edits"])):
+        columns = []
+        for kind in ("compute", "render"):
+            if result[kind] is None:
+                columns += ["-", "-"]
+            else:
+                columns += ["%.3f" % result[kind]["seconds"], "%.1f" % ((result[kind]["peak_rss"] or 0) / 1024.0**2)]
+        print("%-22s %8d %10s %10s %10s %10s" % tuple([name, result["counts"].get("changes", 0)] + columns))
+
+def number_list(type):
+    return lambda value: [type(v) for v in value.split(",")]
+
+def main():
+    if sys.argv[1:2] == ["--measure"]:
+        measure(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], int(sys.argv[6]))
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=number_list(int), default=[5, 20, 80],
+                        help='numbers of pages, comma-separated (default 5,20,80)')
+    parser.add_argument('--words', type=number_list(int), default=[300],
+                        help='numbers of words per page, comma-separated (default 300)')
+    parser.add_argument('--edits', type=number_list(float), default=[.001, .01, .1],
+                        help='fractions of words edited, comma-separated (default 0.001,0.01,0.1)')
+    parser.add_argument('--width', type=int, default=900,
+                        help='width of the rendered image (default 900)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each measurement, of which the best is kept (default 3)')
+    parser.add_argument('--corpus-dir',
+                        help='keep the generated PDFs in this directory for later runs, rather than in a temporary one')
+    parser.add_argument('-o', '--output',
+                        help='write the results as JSON to this file')
+    parser.add_argument('--baseline',
+                        help='compare the results with those in this file')
+    parser.add_argument('--compare', metavar='results',
+                        help='compare the results in this file with the baseline instead of running the benchmarks')
+    parser.add_argument('--time-threshold', type=float, default=.10,
+                        help='report times more than this fraction over the baseline (default 0.10)')
+    parser.add_argument('--memory-threshold', type=float, default=.10,
+                        help='report peak memory more than this fraction over the baseline (default 0.10)')
+    args = parser.parse_args()
+
+    if args.compare:
+        if not args.baseline:
+            parser.error('--compare requires --baseline.')
+        with open(args.compare) as f:
+            results = json.load(f)
+    else:
+        results = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "width": args.width,
+            "cases": { },
+        }
+        with tempfile.TemporaryDirectory(prefix="pdf-diff-bench-") as tmpdir:
+            corpus_dir = args.corpus_dir or tmpdir
+            os.makedirs(corpus_dir, exist_ok=True)
+            for pages in args.pages:
+                for words in args.words:
+                    for edits in args.edits:
+                        case = { "pages": pages, "words": words, "edits": edits }
+                        results["cases"][case_name(case)] = run_case(case, corpus_dir, args.width, args.repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+    print_results(results)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, { "time": args.time_threshold, "memory": args.memory_threshold })
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s." % args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+# Sends concurrent requests to a pdf-diff server and reports the latency
+# percentiles. Unless --url is given, a server is started in this process
+# on a free localhost port, so this runs entirely locally.
+#
+#   python3 benchmarks/load_test.py before.pdf after.pdf [--kind render] [--requests 200] [--concurrency 8]
+
+import argparse, http.client, json, os, sys, threading, time, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# The server's worker processes are started by a process that imports
+# pdf_diff from the default path, so make this copy of it importable there.
+os.environ["PYTHONPATH"] = os.pathsep.join([sys.path[0]] + ([os.environ["PYTHONPATH"]] if os.environ.get("PYTHONPATH") else []))
+from pdf_diff.cache import DiskCache
+from pdf_diff.server import DiffService, RequestHandler, make_server
+
+def send(url, kind, body):
+    # Send one request and return (status, seconds).
+    url = urllib.parse.urlsplit(url)
+    connection = http.client.HTTPConnection(url.hostname, url.port)
+    start = time.perf_counter()
+    connection.request("POST", "/" + kind, json.dumps(body), { "Content-Type": "application/json" })
+    response = connection.getresponse()
+    response.read()
+    seconds = time.perf_counter() - start
+    connection.close()
+    return response.status, seconds
+
+def percentile(sorted_values, p):
+    # The nearest-rank percentile.
+    return sorted_values[max(0, int(round(p / 100.0 * len(sorted_values))) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--kind', choices=['compute', 'render'], default='compute')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--url', help='the server to test, instead of starting one')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='workers of the server that is started')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='queue size of the server that is started')
+    parser.add_argument('--cache-dir', help='cache directory of the server that is started')
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None:
+        RequestHandler.log_message = lambda self, format, *args: None # don't log each request
+        server = make_server(DiffService(args.workers, args.queue_size, DiskCache(args.cache_dir)), port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        args.url = "http://%s:%d" % server.server_address[0:2]
+
+    body = { "before": os.path.abspath(args.before), "after": os.path.abspath(args.after) }
+
+    # One request first to warm up the server and its cache.
+    status, seconds = send(args.url, args.kind, body)
+    print("first request: %d in %.3f seconds" % (status, seconds))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(lambda i: send(args.url, args.kind, body), range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = { }
+    for status, seconds in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    latencies = sorted(seconds for status, seconds in results)
+    print("requests: %d in %.3f seconds (%.1f per second), concurrency %d" % (len(results), elapsed, len(results) / elapsed, args.concurrency))
+    print("statuses: %s" % ", ".join("%d: %d" % item for item in sorted(statuses.items())))
+    print("latency: p50 %.3f  p90 %.3f  p99 %.3f  max %.3f seconds" % (
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99), latencies[-1]))
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+# Generates pairs of synthetic PDFs for benchmarking: a "before" document
+# of a given number of pages and words per page, and an "after" document
+# with a given fraction of its words replaced, deleted or inserted and
+# the text reflowed, as on a real revision. The PDFs are written directly
+# (one Helvetica text stream per page), so nothing but Python is needed.
+# The same arguments always make the same files.
+#
+#   python3 benchmarks/synthetic.py before.pdf after.pdf [pages] [words per page] [edit density] [seed]
+
+import random, sys, zlib
+
+PAGE_WIDTH = 612
+PAGE_HEIGHT = 792
+MARGIN = 72
+LINE_CHARS = 80
+
+def make_words(count, rng):
+    # Random lowercase pseudo-words of the usual lengths.
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for j in range(rng.choice((2, 3, 4, 4, 5, 5, 6, 7, 8, 10))))
+                  for i in range(5000)]
+    return [rng.choice(vocabulary) for i in range(count)]
+
+def edit_words(words, density, rng):
+    # Replace, delete or insert a word at a fraction density of the words.
+    edited = []
+    for word in words:
+        if rng.random() >= density:
+            edited.append(word)
+            continue
+        op = rng.choice(("replace", "delete", "insert"))
+        new_word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for j in range(rng.randint(3, 8)))
+        if op == "replace":
+            edited.append(new_word)
+        elif op == "insert":
+            edited.extend([word, new_word])
+    return edited
+
+def make_lines(words):
+    # Fill lines of up to LINE_CHARS characters.
+    lines = [[]]
+    length = 0
+    for word in words:
+        if lines[-1] and length + 1 + len(word) > LINE_CHARS:
+            lines.append([])
+            length = 0
+        length += len(word) + (1 if lines[-1] else 0)
+        lines[-1].append(word)
+    return [" ".join(line) for line in lines if line]
+
+def write_pdf(fn, lines, lines_per_page):
+    # Write the lines with lines_per_page lines on each page, with the
+    # type size chosen so that they fit.
+    leading = min(14.0, (PAGE_HEIGHT - 2*MARGIN) / float(lines_per_page))
+    font_size = leading * .8
+    pages = [lines[i:i+lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+
+    # Objects 1, 2 and 3 are the catalog, the page tree and the font, and
+    # each page is a page object followed by its content stream.
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    kids = []
+    for page_lines in pages:
+        content = ["BT /F1 %.2f Tf %.2f TL %d %.2f Td" % (font_size, leading, MARGIN, PAGE_HEIGHT - MARGIN - font_size)]
+        for line in page_lines:
+            content.append("(%s) Tj T*" % line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)"))
+        content.append("ET")
+        stream = zlib.compress("\n".join(content).encode("latin-1"))
+        kids.append(len(objects) + 1)
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+                        % (PAGE_WIDTH, PAGE_HEIGHT, len(objects) + 2)).encode("ascii"))
+        objects.append(b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    objects[1] = ("<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join("%d 0 R" % kid for kid in kids), len(kids))).encode("ascii")
+
+    with open(fn, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = []
+        position = f.tell()
+        for i, obj in enumerate(objects):
+            offsets.append(position)
+            data = b"%d 0 obj\n" % (i+1) + obj + b"\nendobj\n"
+            f.write(data)
+            position += len(data)
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, position))
+
+def make_pair(before_fn, after_fn, pages, words_per_page, edit_density, seed=0):
+    # Write a before and after PDF. The after PDF has the same number of
+    # lines per page, so it has about as many pages.
+    rng = random.Random("%d-%d-%r-%d" % (pages, words_per_page, edit_density, seed))
+    words = make_words(pages * words_per_page, rng)
+    lines = make_lines(words)
+    lines_per_page = -(-len(lines) // pages)
+    write_pdf(before_fn, lines, lines_per_page)
+    write_pdf(after_fn, make_lines(edit_words(words, edit_density, rng)), lines_per_page)
+
+if __name__ == "__main__":
+    make_pair(sys.argv[1], sys.argv[2],
+        int(sys.argv[3]) if len(sys.argv) > 3 else 10,
+        int(sys.argv[4]) if len(sys.argv) > 4 else 300,
+        float(sys.argv[5]) if len(sys.argv) > 5 else .01,
+        int(sys.argv[6]) if len(sys.argv) > 6 else 0)
@@ -0,0 +1,93 @@
+# Mark changes on copies of the original PDFs with annotations.
+#
+# Instead of rasterizing the pages, each change is added to its page as
+# a PDF annotation (a box, a strike-out or an underline, according to
+# the style of its PDF), so the work done is proportional to the number
+# of changes. This needs the optional pypdf package, which is imported
+# only when it is used since importing it is slow.
+
+# The annotation subtype for each style.
+ANNOTATION_SUBTYPES = {
+    "box": "/Square",
+    "strike": "/StrikeOut",
+    "underline": "/Underline",
+}
+
+def annotate_changes(changes, styles, outputs, files=None):
+    # Write a copy of each of the two PDFs named in changes (as returned
+    # by compute_changes) to the corresponding file name in outputs, with
+    # its changes marked in the given styles. The file names of the PDFs
+    # can also be given in files, which is needed to copy a PDF that has
+    # no changes.
+    try:
+        import pypdf
+    except ImportError: # install pdf-diff[annotate]
+        raise Exception("Writing annotated PDFs requires the pypdf package.")
+
+    # Merge sequential boxes as render_changes does, so that a changed
+    # run of words is one annotation.
+    from pdf_diff.command_line import simplify_changes
+    changes = simplify_changes(changes)
+
+    files = list(files) if files is not None else [None, None]
+    for change in changes:
+        if change == "*": continue
+        files[change["pdf"]["index"]] = change["pdf"]["file"]
+
+    for pdf_index in (0, 1):
+        if files[pdf_index] is None:
+            continue # no changes, and so no file name, for this side
+        writer = pypdf.PdfWriter(clone_from=files[pdf_index])
+        for change in changes:
+            if change == "*" or change["pdf"]["index"] != pdf_index: continue
+            page = writer.pages[change["page"]["number"] - 1]
+            writer.add_annotation(page, make_annotation(change, page, styles[pdf_index]))
+        with open(outputs[pdf_index], "wb") as f:
+            writer.write(f)
+
+def make_annotation(change, page, style):
+    from pypdf.generic import ArrayObject, DictionaryObject, FloatObject, NameObject, NumberObject, TextStringObject
+
+    # The corners of the change box in the page's default user space:
+    # top left, top right, bottom left, bottom right, in the order of
+    # QuadPoints.
+    corners = [
+        page_point(page, change["page"], change["x"] + dx, change["y"] + dy)
+        for dy in (0, change["height"]) for dx in (0, change["width"])
+    ]
+    xs = [x for x, y in corners]
+    ys = [y for x, y in corners]
+    annotation = DictionaryObject({
+        NameObject("/Type"): NameObject("/Annot"),
+        NameObject("/Subtype"): NameObject(ANNOTATION_SUBTYPES[style]),
+        NameObject("/Rect"): ArrayObject(FloatObject(v) for v in (min(xs), min(ys), max(xs), max(ys))),
+        NameObject("/C"): ArrayObject([FloatObject(1), FloatObject(0), FloatObject(0)]), # red
+        NameObject("/F"): NumberObject(4), # print
+        NameObject("/T"): TextStringObject("pdf-diff"),
+        NameObject("/Contents"): TextStringObject(change["text"].strip()),
+    })
+    if style != "box":
+        annotation[NameObject("/QuadPoints")] = ArrayObject(FloatObject(v) for corner in corners for v in corner)
+    return annotation
+
+def page_point(page, page_size, x, y):
+    # Map a point in the coordinates of pdftotext, which are from the top
+    # left of the page's media box as it is displayed (i.e. rotated) and
+    # scaled to page_size, to the page's default user space, which is from
+    # the bottom left of the page before it is rotated. pdftotext -bbox
+    # uses the media box and not the crop box unless given -cropbox.
+    box = page.mediabox
+    rotation = page.rotation % 360
+    width, height = float(box.width), float(box.height)
+    if rotation in (90, 270):
+        width, height = height, width
+    x *= width / page_size["width"]
+    y *= height / page_size["height"]
+    left, bottom, right, top = float(box.left), float(box.bottom), float(box.right), float(box.top)
+    if rotation == 90:
+        return left + y, bottom + x
+    if rotation == 180:
+        return right - x, bottom + y
+    if rotation == 270:
+        return right - y, top - x
+    return left + x, top - y
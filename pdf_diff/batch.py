@@ -0,0 +1,202 @@
+# Compare many pairs of PDFs in one run.
+#
+# A batch is a list of pairs of PDFs with options for comparing and
+# rendering them. The work is spread over a pool of processes. Each
+# distinct PDF is extracted once, into a cache that the comparisons of
+# all of the pairs it is in then read from, and pages rasterized for one
+# pair are reused by the others through the same cache. The changes of
+# each pair (the JSON accepted by pdf-diff --changes) and its image are
+# written to an output directory, along with a summary of the batch.
+
+import json, os, sys, tempfile, time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from pdf_diff.cache import DiskCache
+from pdf_diff.command_line import compute_change_refs, expand_changes, render_changes, save_change_groups, serialize_pdf, simplify_changes
+
+# The options of a pair, and their defaults.
+DEFAULT_OPTIONS = {
+    "top_margin": 0.0,
+    "bottom_margin": 100.0,
+    "style": "strike,underline",
+    "width": 900,
+    "format": "png",
+    "diff_engine": "char",
+    "page_anchors": False,
+    "region_only": False,
+    "low_memory": False,
+    "render": True, # write an image, and not just the changes
+}
+
+def run_batch(pairs, output_dir, options=None, workers=None, cache=None):
+    # Compare the pairs, each a dict with "before" and "after" file names,
+    # optionally a "name" for its output files (by default its position
+    # in the list, counting from 1), and optionally "options" overriding
+    # the batch's options for the pair. Uses up to workers processes (by
+    # default, one per CPU) and the given DiskCache, or else a temporary
+    # one. Returns the summary, which is also written to summary.json in
+    # output_dir.
+    jobs = []
+    for i, pair in enumerate(pairs):
+        job_options = dict(DEFAULT_OPTIONS)
+        job_options.update(options or {})
+        job_options.update(pair.get("options", {}))
+        unknown = set(job_options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown batch options: %s." % ", ".join(sorted(unknown)))
+        styles = job_options["style"].split(",")
+        if len(styles) != 2 or any(style not in ("box", "strike", "underline") for style in styles):
+            raise ValueError("Invalid style: %s." % job_options["style"])
+        jobs.append({
+            "name": str(pair.get("name") or (i+1)),
+            "files": [pair["before"], pair["after"]],
+            "options": job_options,
+        })
+    if len(set(job["name"] for job in jobs)) != len(jobs):
+        raise ValueError("The names of the pairs in a batch must be unique.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="pdf-diff-batch-") as tmpdir:
+        if cache is None:
+            cache = DiskCache(tmpdir, max_size=None)
+        start = time.time()
+        results = schedule(jobs, output_dir, workers, cache)
+
+    summary = {
+        "pairs": results,
+        "count": len(results),
+        "different": sum(1 for result in results if result.get("changes")),
+        "identical": sum(1 for result in results if result.get("changes") == 0),
+        "errors": sum(1 for result in results if "error" in result),
+        "files": len(set((os.path.realpath(fn), job["options"]["top_margin"], job["options"]["bottom_margin"])
+                         for job in jobs for fn in job["files"])),
+        "seconds": time.time() - start,
+    }
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def schedule(jobs, output_dir, workers, cache):
+    # Extract each distinct file (with its margins) first, and queue the
+    # comparison of each pair as soon as both of its files are extracted.
+    # A failed extraction isn't handled here: the comparison will fail
+    # the same way and record the error.
+    def extraction_key(job, fn):
+        return (os.path.realpath(fn), float(job["options"]["top_margin"]), float(job["options"]["bottom_margin"]))
+
+    with ProcessPoolExecutor(workers) as executor:
+        extractions = { }
+        for job in jobs:
+            for fn in job["files"]:
+                key = extraction_key(job, fn)
+                if key not in extractions:
+                    extractions[key] = executor.submit(extract, fn, key[1], key[2], cache)
+
+        waiting = list(enumerate(jobs))
+        comparisons = { }
+        results = [None] * len(jobs)
+        running = set(extractions.values())
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in comparisons:
+                    results[comparisons[future]] = future.result()
+
+            still_waiting = []
+            for i, job in waiting:
+                if all(extractions[extraction_key(job, fn)].done() for fn in job["files"]):
+                    future = executor.submit(compare_pair, job, output_dir, cache)
+                    comparisons[future] = i
+                    running.add(future)
+                else:
+                    still_waiting.append((i, job))
+            waiting = still_waiting
+    return results
+
+def extract(fn, top_margin, bottom_margin, cache):
+    # Run in a worker: extract a file into the cache.
+    serialize_pdf(0, fn, top_margin, bottom_margin, cache=cache)
+
+def compare_pair(job, output_dir, cache):
+    # Run in a worker: compare a pair, write its output files, and return
+    # its entry in the summary. Errors are reported in the summary rather
+    # than stopping the batch.
+    start = time.time()
+    options = job["options"]
+    result = {
+        "name": job["name"],
+        "before": job["files"][0],
+        "after": job["files"][1],
+    }
+    try:
+        changes, docs = compute_change_refs(job["files"][0], job["files"][1],
+            top_margin=float(options["top_margin"]), bottom_margin=float(options["bottom_margin"]),
+            cache=cache, engine=options["diff_engine"], page_anchors=options["page_anchors"])
+        changes = expand_changes(simplify_changes(changes, docs), docs)
+        del docs
+
+        result["changes"] = sum(1 for change in changes if change != "*")
+        result["json"] = os.path.join(output_dir, job["name"] + ".json")
+        with open(result["json"], "w") as f:
+            json.dump(changes, f)
+
+        if options["render"] and result["changes"] > 0:
+            img = render_changes(changes, options["style"].split(","), int(options["width"]),
+                cache=cache, region_only=options["region_only"], low_memory=options["low_memory"])
+            result["image"] = os.path.join(output_dir, job["name"] + "." + options["format"])
+            if options["format"] == "pdf":
+                save_change_groups([img], result["image"], "pdf")
+            else:
+                img.save(result["image"], options["format"].upper())
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+    result["seconds"] = time.time() - start
+    return result
+
+def load_manifest(fn):
+    # Read a manifest: a JSON file with the "pairs" of a batch and the
+    # batch's "options" (see run_batch), or just the list of pairs. File
+    # names are relative to the manifest's directory.
+    with open(fn) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = { "pairs": manifest }
+    base = os.path.dirname(os.path.abspath(fn))
+    for pair in manifest["pairs"]:
+        pair["before"] = os.path.join(base, pair["before"])
+        pair["after"] = os.path.join(base, pair["after"])
+    return manifest
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pdf-diff batch',
+        description='Compares the pairs of PDFs listed in a JSON manifest, writing the changes (as JSON) '
+                    'and an image for each pair and a summary.json to an output directory.')
+    parser.add_argument('manifest',
+                        help='a JSON file with "pairs", a list of {"before": file, "after": file, "name": name, "options": {...}}, '
+                             'and "options" for all pairs: %s' % ', '.join(sorted(DEFAULT_OPTIONS)))
+    parser.add_argument('-o', '--output-dir', metavar='dir', required=True,
+                        help='directory to write the output files to')
+    parser.add_argument('-j', '--workers', metavar='N', type=int,
+                        help='number of worker processes (default: the number of CPUs)')
+    parser.add_argument('--cache-dir', metavar='dir',
+                        help='keep the extracted text and rasterized pages in this cache directory for later runs, rather than in a temporary one')
+    args = parser.parse_args(argv)
+
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1.')
+
+    manifest = load_manifest(args.manifest)
+    cache = DiskCache(args.cache_dir) if args.cache_dir else None
+    try:
+        summary = run_batch(manifest["pairs"], args.output_dir, manifest.get("options"), args.workers, cache)
+    except ValueError as e:
+        parser.error(str(e))
+
+    for result in summary["pairs"]:
+        if "error" in result:
+            sys.stderr.write('ERROR: %s: %s%s' % (result["name"], result["error"], os.linesep))
+    sys.stderr.write('%d pairs: %d different, %d identical, %d errors (%d files extracted, %.1f seconds).%s' % (
+        summary["count"], summary["different"], summary["identical"], summary["errors"], summary["files"], summary["seconds"], os.linesep))
+    sys.exit(1 if summary["errors"] else 0)
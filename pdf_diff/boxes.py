@@ -0,0 +1,177 @@
+# Column-oriented storage for the word boxes of a PDF.
+#
+# Rather than one dict per word, a BoxStore keeps each box field in a
+# typed array, the text of all of the boxes in one string (the document
+# text that is diffed, where each box's text is a slice), and a table of
+# pages shared by the boxes. Boxes are addressed by their row number and
+# are only turned into the dicts of the change JSON on output.
+
+import json, struct, sys
+from array import array
+
+class BoxStore:
+    # (field, typecode) of the per-box columns.
+    COLUMNS = [
+        ("index", "L"),      # the box's position in the output of pdf_to_bboxes
+        ("page", "L"),       # a row in the page table
+        ("x", "d"),
+        ("y", "d"),
+        ("width", "d"),
+        ("height", "d"),
+        ("startIndex", "Q"), # where the box's text is in the document text
+        ("textLength", "L"),
+    ]
+
+    def __init__(self, pdf_index, fn):
+        self.pdf = {
+            "index": pdf_index,
+            "file": fn,
+        }
+        self.pages = [] # page dicts, shared by the boxes on each page
+        for field, typecode in self.COLUMNS:
+            setattr(self, field, array(typecode))
+        self.text = ""
+
+        # The raw text of each box while the store is being built, before
+        # the text is normalized into self.text.
+        self.texts = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, row):
+        return self.box(row)
+
+    def __iter__(self):
+        return (self.box(row) for row in range(len(self)))
+
+    def append(self, box):
+        # Add a box dict from pdf_to_bboxes. The startIndex and textLength
+        # columns are filled in later, once the text is normalized.
+        if len(self.pages) == 0 or self.pages[-1]["number"] != box["page"]["number"]:
+            self.pages.append(box["page"])
+        self.index.append(box["index"])
+        self.page.append(len(self.pages) - 1)
+        self.x.append(box["x"])
+        self.y.append(box["y"])
+        self.width.append(box["width"])
+        self.height.append(box["height"])
+        self.texts.append(box["text"])
+
+    def extend(self, other):
+        # Add the boxes of another store that is being built, of the pages
+        # after this one's, renumbering their index as if they had been
+        # appended here.
+        offset = len(self)
+        page_offset = len(self.pages)
+        self.pages.extend(other.pages)
+        self.index.extend(index + offset for index in other.index)
+        self.page.extend(page + page_offset for page in other.page)
+        for field in ("x", "y", "width", "height"):
+            getattr(self, field).extend(getattr(other, field))
+        self.texts.extend(other.texts)
+
+    def select(self, rows):
+        # Keep only the given rows (in order) of the columns filled in by
+        # append.
+        for field, typecode in self.COLUMNS:
+            if field in ("startIndex", "textLength"): continue
+            column = getattr(self, field)
+            setattr(self, field, array(typecode, (column[row] for row in rows)))
+
+    def box_text(self, row):
+        start = self.startIndex[row]
+        return self.text[start:start+self.textLength[row]]
+
+    def box(self, row):
+        # Expand a row into the dict used in the change JSON.
+        return {
+            "index": self.index[row],
+            "pdf": self.pdf,
+            "page": self.pages[self.page[row]],
+            "x": self.x[row],
+            "y": self.y[row],
+            "width": self.width[row],
+            "height": self.height[row],
+            "text": self.box_text(row),
+            "startIndex": self.startIndex[row],
+            "textLength": self.textLength[row],
+        }
+
+    def run(self, first, last):
+        # Expand the consecutive rows first...last into one dict the way
+        # simplify_changes merges boxes: the merged box has the position
+        # of the first box, extends to the right edge of the last, and
+        # takes the index of the last.
+        box = self.box(first)
+        if last != first:
+            box["index"] = self.index[last]
+            box["width"] = self.x[last] + self.width[last] - self.x[first]
+            box["text"] = self.text[self.startIndex[first]:self.startIndex[last]+self.textLength[last]]
+        return box
+
+    def offset(self, row):
+        # The offset into the document text where the row's text starts,
+        # or the length of the text for the row after the last.
+        return self.startIndex[row] if row < len(self) else len(self.text)
+
+    def page_rows(self):
+        # The range of rows on each page in the page table.
+        rows = []
+        row = 0
+        for page in range(len(self.pages)):
+            first = row
+            while row < len(self) and self.page[row] == page:
+                row += 1
+            rows.append(range(first, row))
+        return rows
+
+    def ends(self):
+        # The offsets into the document text where each box's text ends.
+        return array("Q", map(int.__add__, self.startIndex, self.textLength))
+
+    # Serialization to a compact binary format: a small JSON header with
+    # the page table followed by each column and then the document text
+    # as UTF-8.
+
+    MAGIC = b"PDFDIFF-BOXES-1\n"
+
+    def to_bytes(self):
+        header = json.dumps({
+            "count": len(self),
+            "pages": [[page["number"], page["width"], page["height"]] for page in self.pages],
+            "byteorder": sys.byteorder,
+            "itemsizes": [getattr(self, field).itemsize for field, typecode in self.COLUMNS],
+        }).encode("utf8")
+        chunks = [self.MAGIC, struct.pack("<Q", len(header)), header]
+        for field, typecode in self.COLUMNS:
+            chunks.append(getattr(self, field).tobytes())
+        chunks.append(self.text.encode("utf8"))
+        return b"".join(chunks)
+
+    @classmethod
+    def from_bytes(cls, data, pdf_index, fn):
+        # Load a store serialized by to_bytes as document pdf_index with
+        # file name fn.
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("Not a serialized BoxStore.")
+        pos = len(cls.MAGIC)
+        header_length, = struct.unpack_from("<Q", data, pos)
+        pos += 8
+        header = json.loads(data[pos:pos+header_length].decode("utf8"))
+        pos += header_length
+
+        store = cls(pdf_index, fn)
+        store.pages = [{ "number": number, "width": width, "height": height }
+                       for number, width, height in header["pages"]]
+        for (field, typecode), itemsize in zip(cls.COLUMNS, header["itemsizes"]):
+            column = getattr(store, field)
+            if column.itemsize != itemsize:
+                raise ValueError("BoxStore was serialized on an incompatible platform.")
+            column.frombytes(data[pos:pos+header["count"]*itemsize])
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            pos += header["count"]*itemsize
+        store.text = data[pos:].decode("utf8")
+        store.texts = None
+        return store
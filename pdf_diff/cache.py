@@ -0,0 +1,182 @@
+# A persistent, content-addressed cache on disk.
+#
+# Entries are files named by a hash key and grouped by namespace (e.g.
+# "boxes" for extracted word boxes). Writers write to a temporary file and
+# rename it into place, so readers in other processes never see a partial
+# entry. Reading an entry touches it, and when the cache grows past its
+# size limit the least-recently-used entries are removed.
+#
+# Finding the size of the cache means listing every entry, so it is only
+# done when the size found last time, plus what this process has written
+# since, is over the limit. Entries are then removed until the cache is
+# a little under the limit, so that the next few writes don't need
+# another listing.
+#
+# The cache directory may be one the user also keeps other files in, so
+# only files at an entry's path and named like a key are ever listed or
+# removed.
+
+import hashlib, json, os, re, stat, tempfile
+
+try:
+    import fcntl
+except ImportError: # not available on Windows
+    fcntl = None
+
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024 # bytes
+
+# The fraction of max_size that eviction shrinks the cache to.
+EVICT_TO = .9
+
+# The form of the keys made by cache_key.
+KEY_PATTERN = re.compile("[0-9a-f]{64}$")
+
+def default_cache_dir():
+    if os.environ.get("PDF_DIFF_CACHE_DIR"):
+        return os.environ["PDF_DIFF_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pdf-diff")
+
+def file_digest(fn):
+    # Hash the bytes of a file.
+    h = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def cache_key(*parts):
+    # Make a cache key out of JSON-serializable parts.
+    return hashlib.sha256(json.dumps(parts).encode("utf8")).hexdigest()
+
+class DiskCache:
+    def __init__(self, path=None, max_size=DEFAULT_MAX_SIZE):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+        self.size_estimate = None # not known until the cache is listed
+        self.bytes_written = 0 # by put, in this process
+
+    def entry_path(self, namespace, key):
+        if not KEY_PATTERN.match(key):
+            raise ValueError("Invalid cache key: %r" % key)
+        return os.path.join(self.path, namespace, key[0:2], key)
+
+    def get(self, namespace, key):
+        # Return the bytes stored under key, or None.
+        fn = self.entry_path(namespace, key)
+        try:
+            with open(fn, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # Mark the entry as recently used.
+        try:
+            os.utime(fn)
+        except OSError:
+            pass # evicted in the meanwhile
+
+        return data
+
+    def put(self, namespace, key, data):
+        fn = self.entry_path(namespace, key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_fn, fn)
+        except:
+            os.unlink(tmp_fn)
+            raise
+        self.bytes_written += len(data)
+        self.added(len(data))
+
+    def added(self, size):
+        # Account for size bytes of new entries, evicting entries if the
+        # cache may have grown past max_size. A process that writes many
+        # entries through copies of this DiskCache with no max_size can
+        # call this with the bytes_written of the copies, so that the
+        # copies never list the cache.
+        if self.size_estimate is not None:
+            self.size_estimate += size
+        if self.max_size is not None and (self.size_estimate is None or self.size_estimate > self.max_size):
+            self.evict()
+
+    def entries(self):
+        # List (mtime, size, path) of all entries, i.e. the files at
+        # namespace/key[0:2]/key. Temporary files and the lock file start
+        # with a dot and other files aren't named like keys, so they are
+        # skipped.
+        entries = []
+        for namespace in list_dir(self.path):
+            for prefix in list_dir(os.path.join(self.path, namespace)):
+                for name in list_dir(os.path.join(self.path, namespace, prefix)):
+                    if not KEY_PATTERN.match(name) or name[0:2] != prefix: continue
+                    fn = os.path.join(self.path, namespace, prefix, name)
+                    try:
+                        st = os.lstat(fn)
+                    except FileNotFoundError:
+                        continue # removed by another process
+                    if not stat.S_ISREG(st.st_mode): continue
+                    entries.append((st.st_mtime, st.st_size, fn))
+        return entries
+
+    def evict(self):
+        # If the cache doesn't fit within max_size, remove least-recently-
+        # used entries until it fits within EVICT_TO of it, unless max_size
+        # is None (no limit).
+        if self.max_size is None:
+            return
+        with self.lock():
+            entries = self.entries()
+            total_size = sum(size for mtime, size, fn in entries)
+            target_size = self.max_size if total_size <= self.max_size else self.max_size * EVICT_TO
+            for mtime, size, fn in sorted(entries):
+                if total_size <= target_size:
+                    break
+                try:
+                    os.unlink(fn)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue # e.g. open in another process on Windows
+                total_size -= size
+            self.size_estimate = total_size
+
+    def clear(self):
+        with self.lock():
+            for mtime, size, fn in self.entries():
+                try:
+                    os.unlink(fn)
+                except OSError:
+                    pass
+            self.size_estimate = None
+
+    def lock(self):
+        # Serialize eviction among processes sharing the cache. Reads and
+        # writes don't need the lock.
+        os.makedirs(self.path, exist_ok=True)
+        return FileLock(os.path.join(self.path, ".lock"))
+
+def list_dir(path):
+    # The names in a directory, or none if path isn't a directory.
+    try:
+        return os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+class FileLock:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __enter__(self):
+        self.f = open(self.fn, "a")
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
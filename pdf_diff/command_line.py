@@ -5,131 +5,682 @@ import sys
 if sys.version_info[0] < 3:
     sys.exit("ERROR: Python version 3+ is required.")
 
-import json, subprocess, io, os
+import atexit, json, subprocess, io, os, hashlib, time, re, tempfile, math, itertools
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from lxml import etree
-from PIL import Image, ImageDraw, ImageOps
-
-def compute_changes(pdf_fn_1, pdf_fn_2, top_margin=0, bottom_margin=100):
-    # Serialize the text in the two PDFs.
-    docs = [serialize_pdf(0, pdf_fn_1, top_margin, bottom_margin), serialize_pdf(1, pdf_fn_2, top_margin, bottom_margin)]
-
-    # Compute differences between the serialized text.
-    diff = perform_diff(docs[0][1], docs[1][1])
-    changes = process_hunks(diff, [docs[0][0], docs[1][0]])
-
+from PIL import Image, ImageDraw, ImageOps, TiffImagePlugin
+
+from pdf_diff.annotate import annotate_changes
+from pdf_diff.boxes import BoxStore
+from pdf_diff.cache import DiskCache, DEFAULT_MAX_SIZE, cache_key, file_digest
+from pdf_diff.imagepdf import PdfImageWriter
+from pdf_diff import profiling
+
+# Bump this whenever a change to pdf_to_bboxes, mark_eol_hyphens or
+# serialize_pdf changes their output, so that cached boxes are not reused.
+EXTRACTOR_VERSION = 1
+
+def compute_changes(pdf_fn_1, pdf_fn_2, top_margin=0, bottom_margin=100, workers=1, cache=None, engine="char", page_anchors=False, budget=None):
+    # Compute the changes between two PDFs as a list of changed boxes, as
+    # dicts, and "*" markers.
+    changes, docs = compute_change_refs(pdf_fn_1, pdf_fn_2, top_margin, bottom_margin, workers, cache, engine, page_anchors, budget)
+    return expand_changes(changes, docs)
+
+def compute_change_refs(pdf_fn_1, pdf_fn_2, top_margin=0, bottom_margin=100, workers=1, cache=None, engine="char", page_anchors=False, budget=None):
+    # Like compute_changes, but return the changed boxes as (pdf index, row)
+    # references into the BoxStores of the two PDFs, which are returned too.
+    #
+    # Serialize the text in the two PDFs. With more than one worker, the
+    # two PDFs are extracted at the same time and each is split into page
+    # ranges that share one pool of workers. If a DiskCache is given,
+    # previously extracted PDFs are loaded from it.
+    with profiling.stage("extract"):
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as executor, ThreadPoolExecutor(2) as doc_executor:
+                docs = [doc_executor.submit(serialize_pdf, 0, pdf_fn_1, top_margin, bottom_margin, workers, executor, cache),
+                        doc_executor.submit(serialize_pdf, 1, pdf_fn_2, top_margin, bottom_margin, workers, executor, cache)]
+                docs = [doc.result() for doc in docs]
+        else:
+            docs = [serialize_pdf(0, pdf_fn_1, top_margin, bottom_margin, cache=cache), serialize_pdf(1, pdf_fn_2, top_margin, bottom_margin, cache=cache)]
+    profiling.count("words", len(docs[0]) + len(docs[1]))
+
+    return diff_docs(docs, engine, page_anchors, budget), docs
+
+def diff_docs(docs, engine="char", page_anchors=False, budget=None):
+    # Compute differences between the serialized text of two BoxStores,
+    # either character by character or word by word (engine "word"), and
+    # return the changed boxes as (pdf index, row) references. With
+    # page_anchors, pages that are unchanged between the two PDFs are
+    # found first and only the text between them is diffed. With a
+    # DiffBudget, the text is diffed in segments that are each limited in
+    # time and size.
+    with profiling.stage("diff"):
+        if page_anchors:
+            diff = perform_page_anchored_diff(docs, engine, budget)
+        else:
+            diff = diff_rows(docs, range(len(docs[0])), range(len(docs[1])), engine, budget)
+    profiling.count("hunks", len(diff))
+    with profiling.stage("process_hunks"):
+        changes = process_hunks(diff, docs)
+    profiling.count("changes", sum(1 for change in changes if change != "*"))
     return changes
 
-def serialize_pdf(i, fn, top_margin, bottom_margin):
-    box_generator = pdf_to_bboxes(i, fn, top_margin, bottom_margin)
-    box_generator = mark_eol_hyphens(box_generator)
-
-    boxes = []
+def expand_changes(changes, docs):
+    # Turn (pdf index, row) references, or (pdf index, first row, last row)
+    # runs from simplify_changes, into the dicts of the change JSON.
+    expanded = []
+    for change in changes:
+        if change == "*":
+            expanded.append(change)
+        elif len(change) == 2:
+            expanded.append(docs[change[0]].box(change[1]))
+        else:
+            expanded.append(docs[change[0]].run(change[1], change[2]))
+    return expanded
+
+def serialize_pdf(i, fn, top_margin, bottom_margin, workers=1, executor=None, cache=None):
+    if cache is not None:
+        # The cache is keyed by the PDF's content, not its file name, and
+        # by everything else that affects the extracted boxes.
+        key = cache_key("boxes", EXTRACTOR_VERSION, file_digest(fn), float(top_margin), float(bottom_margin))
+        data = cache.get("boxes", key)
+        if data is not None:
+            profiling.count("boxes_cache_hits", 1)
+            return BoxStore.from_bytes(data, i, fn)
+        boxes = serialize_pdf(i, fn, top_margin, bottom_margin, workers, executor)
+        cache.put("boxes", key, boxes.to_bytes())
+        return boxes
+
+    if workers > 1 and executor is None:
+        with ThreadPoolExecutor(workers) as executor:
+            return serialize_pdf(i, fn, top_margin, bottom_margin, workers, executor)
+
+    # Collect the boxes into a BoxStore.
+    boxes = BoxStore(i, fn)
+    if executor is not None:
+        for shard in pdf_to_bboxes_parallel(i, fn, top_margin, bottom_margin, executor, workers):
+            boxes.extend(shard)
+    else:
+        for box in pdf_to_bboxes(i, fn, top_margin, bottom_margin):
+            boxes.append(box)
+    with profiling.stage("normalize"):
+        mark_eol_hyphens(boxes)
+        normalize_boxes(boxes)
+    return boxes
+
+def normalize_boxes(boxes):
+    # Normalize the raw text of the boxes in a BoxStore into the document
+    # text, dropping boxes without text.
+    rows = []
     text = []
     textlength = 0
-    for run in box_generator:
-        if run["text"] is None:
+    for row, run_text in enumerate(boxes.texts):
+        if run_text is None:
             continue
 
-        normalized_text = run["text"].strip()
-
-        # Ensure that each run ends with a space, since pdftotext
-        # strips spaces between words. If we do a word-by-word diff,
-        # that would be important.
-        #
-        # But don't put in a space if the box ends in a discretionary
-        # hyphen. Instead, remove the hyphen.
-        if normalized_text.endswith("\u00AD"):
-            normalized_text = normalized_text[0:-1]
-        else:
-            normalized_text += " "
-
-        run["text"] = normalized_text
-        run["startIndex"] = textlength
-        run["textLength"] = len(normalized_text)
-        boxes.append(run)
+        normalized_text = normalize_box_text(run_text)
+        rows.append(row)
+        boxes.startIndex.append(textlength)
+        boxes.textLength.append(len(normalized_text))
         text.append(normalized_text)
         textlength += len(normalized_text)
 
-    text = "".join(text)
-    return boxes, text
+    boxes.select(rows)
+    boxes.texts = None
+    boxes.text = "".join(text)
+
+def normalize_box_text(text):
+    normalized_text = text.strip()
+
+    # Ensure that each run ends with a space, since pdftotext
+    # strips spaces between words. If we do a word-by-word diff,
+    # that would be important.
+    #
+    # But don't put in a space if the box ends in a discretionary
+    # hyphen. Instead, remove the hyphen.
+    if normalized_text.endswith("\u00AD"):
+        normalized_text = normalized_text[0:-1]
+    else:
+        normalized_text += " "
+
+    return normalized_text
+
+def check_identical(pdf_fn_1, pdf_fn_2, top_margin=0, bottom_margin=100):
+    # Check whether two PDFs have the same text, i.e. whether
+    # compute_changes would find no changes, without diffing them. The
+    # text of both PDFs is extracted and normalized a page at a time and
+    # compared as it arrives, and extraction stops at the first
+    # difference. Returns None if the text is the same, or else a dict
+    # { "pdfs": [{ "file": ..., "page": ... }, ...] } giving the page of
+    # each PDF where the text first differs, with a page of None for a
+    # PDF whose text ended first.
+    #
+    # Only the text is compared, and not which page it is on, so text
+    # that merely flowed onto another page is not a difference.
+    fns = (pdf_fn_1, pdf_fn_2)
+    pages = [page_texts(i, fn, top_margin, bottom_margin) for i, fn in enumerate(fns)]
+    try:
+        # The [page number, text] of each PDF that is not compared yet.
+        pending = [None, None]
+        while True:
+            for i in (0, 1):
+                if pending[i] is None:
+                    pending[i] = next(pages[i], None)
+            if pending[0] is None and pending[1] is None:
+                return None
+            if pending[0] is None or pending[1] is None \
+                or not pending[0][1].startswith(pending[1][1]) and not pending[1][1].startswith(pending[0][1]):
+                return {
+                    "pdfs": [{ "file": fn, "page": page[0] if page is not None else None }
+                             for fn, page in zip(fns, pending)],
+                }
 
-def pdf_to_bboxes(pdf_index, fn, top_margin=0, bottom_margin=100):
+            # One text is a prefix of the other. Drop the shorter one and
+            # that much of the longer one.
+            n = min(len(pending[0][1]), len(pending[1][1]))
+            for i in (0, 1):
+                pending[i][1] = pending[i][1][n:]
+                if pending[i][1] == "":
+                    pending[i] = None
+    finally:
+        # Stop pdftotext if there is a difference before the end.
+        for page_generator in pages:
+            page_generator.close()
+
+def page_texts(i, fn, top_margin, bottom_margin):
+    # Extract the normalized text of a PDF a page at a time, the same way
+    # serialize_pdf does for the whole document, as [page number, text]
+    # for each page with text.
+    box_generator = pdf_to_bboxes(i, fn, top_margin, bottom_margin)
+    try:
+        boxes = BoxStore(i, fn)
+        for box in itertools.chain(box_generator, [None]):
+            if box is None or (len(boxes) > 0 and box["page"] is not boxes.pages[-1]):
+                # The last box of each page ends a line, so hyphens and
+                # normalization don't depend on the boxes of other pages.
+                mark_eol_hyphens(boxes)
+                normalize_boxes(boxes)
+                if boxes.text != "":
+                    yield [boxes.pages[-1]["number"], boxes.text]
+                boxes = BoxStore(i, fn)
+            if box is not None:
+                boxes.append(box)
+    finally:
+        box_generator.close()
+
+# pdftotext can emit these control characters, but they are not allowed
+# in XML and would cause PCDATA errors.
+XML_INVALID_BYTES = bytes([ 0, 1, 2, 3, 4, 5, 6, 7, 8,
+                            11, 12,
+                            14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, ])
+
+XHTML_PAGE = "{http://www.w3.org/1999/xhtml}page"
+XHTML_WORD = "{http://www.w3.org/1999/xhtml}word"
+
+def pdf_to_bboxes(pdf_index, fn, top_margin=0, bottom_margin=100, first_page=None, last_page=None):
     # Get the bounding boxes of text runs in the PDF.
     # Each text run is returned as a dict.
+    # first_page and last_page optionally restrict extraction to a range
+    # of (1-based) page numbers.
+    #
+    # The output of pdftotext is parsed incrementally as it is produced,
+    # and each page is discarded once its words have been yielded, so
+    # memory use depends on the size of a page and not of the document.
     box_index = 0
     pdfdict = {
         "index": pdf_index,
         "file": fn,
     }
-    xml = subprocess.check_output(["pdftotext", "-bbox", fn, "-"])
-
-    # This avoids PCDATA errors
-    codes_to_avoid = [ 0, 1, 2, 3, 4, 5, 6, 7, 8,
-                       11, 12,
-                       14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, ]
-
-    cleaned_xml = bytes([x for x in xml if x not in codes_to_avoid])
-
-    dom = etree.fromstring(cleaned_xml)
-    for i, page in enumerate(dom.findall(".//{http://www.w3.org/1999/xhtml}page")):
-        pagedict = {
-            "number": i+1,
-            "width": float(page.get("width")),
-            "height": float(page.get("height"))
-        }
-        for word in page.findall("{http://www.w3.org/1999/xhtml}word"):
-            if float(word.get("yMax")) < (top_margin/100.0)*float(page.get("height")):
-                continue
-            if float(word.get("yMin")) > (bottom_margin/100.0)*float(page.get("height")):
-                continue
+    page_range = []
+    if first_page is not None:
+        page_range += ["-f", str(first_page)]
+    if last_page is not None:
+        page_range += ["-l", str(last_page)]
+    cmd = ["pdftotext", "-bbox"] + page_range + [fn, "-"]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        parser = etree.XMLPullParser(events=("start", "end"), tag=(XHTML_PAGE, XHTML_WORD))
+        page_number = (first_page or 1) - 1
+        for chunk in iter(lambda: proc.stdout.read(65536), b""):
+            with profiling.stage("parse_xml"):
+                parser.feed(chunk.translate(None, XML_INVALID_BYTES))
+            for event, element in parser.read_events():
+                if element.tag == XHTML_PAGE:
+                    if event == "start":
+                        page_number += 1
+                        pagedict = {
+                            "number": page_number,
+                            "width": float(element.get("width")),
+                            "height": float(element.get("height"))
+                        }
+                    else:
+                        # Done with this page.
+                        element.clear()
+                        element.getparent().remove(element)
+                    continue
 
-            yield {
-                "index": box_index,
-                "pdf": pdfdict,
-                "page": pagedict,
-                "x": float(word.get("xMin")),
-                "y": float(word.get("yMin")),
-                "width": float(word.get("xMax"))-float(word.get("xMin")),
-                "height": float(word.get("yMax"))-float(word.get("yMin")),
-                "text": word.text,
-                }
-            box_index += 1
+                if event == "start":
+                    # Wait for the word's text.
+                    continue
+
+                word = element
+                if float(word.get("yMax")) < (top_margin/100.0)*pagedict["height"] \
+                    or float(word.get("yMin")) > (bottom_margin/100.0)*pagedict["height"]:
+                    word.clear()
+                    continue
+
+                yield {
+                    "index": box_index,
+                    "pdf": pdfdict,
+                    "page": pagedict,
+                    "x": float(word.get("xMin")),
+                    "y": float(word.get("yMin")),
+                    "width": float(word.get("xMax"))-float(word.get("xMin")),
+                    "height": float(word.get("yMax"))-float(word.get("yMin")),
+                    "text": word.text,
+                    }
+                box_index += 1
+                word.clear()
+
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        profiling.subprocess_time("pdftotext", time.perf_counter() - start)
+        parser.close()
+    finally:
+        # If we stopped early (an error, or the consumer closed the
+        # generator), don't leave pdftotext running.
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+def pdf_page_count(fn):
+    # Ask pdfinfo how many pages are in the PDF.
+    start = time.perf_counter()
+    info = subprocess.check_output(["pdfinfo", fn]).decode("utf8", "replace")
+    profiling.subprocess_time("pdfinfo", time.perf_counter() - start)
+    for line in info.splitlines():
+        if line.startswith("Pages:"):
+            return int(line.split(":", 1)[1])
+    raise ValueError("pdfinfo did not report a page count for %s." % fn)
+
+def page_ranges(page_count, shards):
+    # Split the pages 1...page_count into at most `shards` contiguous
+    # (first, last) ranges of nearly equal length.
+    shards = max(1, min(shards, page_count))
+    size, extra = divmod(page_count, shards)
+    ranges = []
+    first = 1
+    for i in range(shards if page_count > 0 else 0):
+        last = first + size - 1 + (1 if i < extra else 0)
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+def pdf_to_bboxes_parallel(pdf_index, fn, top_margin, bottom_margin, executor, shards):
+    # Like pdf_to_bboxes, but run one pdftotext per page range in the
+    # executor, collecting the boxes of each range into a BoxStore as
+    # serialize_pdf does. The shards are started immediately. The returned
+    # generator yields the stores in page order, and drops each one as it
+    # is yielded so that the caller can merge them into one without
+    # keeping them all.
+    def extract(first_page, last_page):
+        boxes = BoxStore(pdf_index, fn)
+        for box in pdf_to_bboxes(pdf_index, fn, top_margin, bottom_margin, first_page, last_page):
+            boxes.append(box)
+        return boxes
+    futures = deque(executor.submit(extract, first_page, last_page)
+                    for first_page, last_page in page_ranges(pdf_page_count(fn), shards))
+
+    def stitch():
+        while futures:
+            yield futures.popleft().result()
+    return stitch()
 
 def mark_eol_hyphens(boxes):
     # Replace end-of-line hyphens with discretionary hyphens so we can weed
-    # those out later. Finding the end of a line is hard.
-    box = None
-    for next_box in boxes:
-        if box is not None:
-            if box['pdf'] != next_box['pdf'] or box['page'] != next_box['page'] \
-                or next_box['y'] >= box['y'] + box['height']/2:
-                # box was at the end of a line
-                mark_eol_hyphen(box)
-            yield box
-        box = next_box
-    if box is not None:
-        # The last box is at the end of a line too.
-        mark_eol_hyphen(box)
-        yield box
-
-def mark_eol_hyphen(box):
-	if box['text'] is not None:
-	    if box['text'].endswith("-"):
-        	box['text'] = box['text'][0:-1] + "\u00AD"
-
-def perform_diff(doc1text, doc2text):
+    # those out later. Finding the end of a line is hard. This works on the
+    # raw text of a BoxStore that is being built.
+    for row in range(len(boxes.texts)):
+        if row+1 == len(boxes.texts) or boxes.page[row] != boxes.page[row+1] \
+            or boxes.y[row+1] >= boxes.y[row] + boxes.height[row]/2:
+            # The box is at the end of a line. (The last box is at the end
+            # of a line too.)
+            mark_eol_hyphen(boxes, row)
+
+def mark_eol_hyphen(boxes, row):
+    text = boxes.texts[row]
+    if text is not None:
+        if text.endswith("-"):
+            boxes.texts[row] = text[0:-1] + "\u00AD"
+
+def perform_diff(doc1text, doc2text, timelimit=0):
     import diff_match_patch
     return diff_match_patch.diff(
         doc1text,
         doc2text,
-        timelimit=0,
+        timelimit=timelimit,
+        checklines=False)
+
+def diff_rows(docs, rows1, rows2, engine, budget=None, timelimit=0):
+    # Diff the text of a range of rows of each of the two BoxStores in docs
+    # with the given engine.
+    if budget is not None:
+        return perform_budgeted_diff(docs, rows1, rows2, engine, budget)
+    if engine == "char":
+        return perform_diff(
+            docs[0].text[docs[0].offset(rows1.start):docs[0].offset(rows1.stop)],
+            docs[1].text[docs[1].offset(rows2.start):docs[1].offset(rows2.stop)],
+            timelimit)
+    elif engine == "word":
+        return perform_word_diff(docs[0], docs[1], rows1, rows2, timelimit)
+    else:
+        raise ValueError(engine)
+
+class DiffBudget:
+    # Limits for perform_budgeted_diff: the number of seconds the diff of
+    # each segment may take, and the number of characters of text (in both
+    # documents together) a segment may have, or None for no limit. The
+    # segments that exceeded the budget are collected in degraded.
+    def __init__(self, time=None, size=None):
+        self.time = time
+        self.size = size
+        self.degraded = []
+
+def perform_budgeted_diff(docs, rows1, rows2, engine, budget):
+    # Diff ranges of rows of two BoxStores in segments, so that no single
+    # diff can take unbounded time or memory. As in a patience diff, the
+    # words that occur exactly once in each range are lined up, and the
+    # text between those anchors is diffed segment by segment. The words
+    # that a segment starts and ends with in both documents are taken off
+    # first, so a segment whose text is the same is not diffed at all. A
+    # segment that is still too large is split the same way at the words
+    # that are unique within it. A segment that is too large and can't be
+    # split, or whose diff takes too long, is marked as entirely changed
+    # instead and is recorded in budget.degraded.
+    hunks = []
+
+    # The work still to do, in order from the end of the list: ("diff",
+    # rows1, rows2) to diff a segment, and ("same", length) for text that
+    # is the same in both documents.
+    pending = []
+    push_segments(pending, docs, rows1, rows2, align_unique_words(docs, rows1, rows2))
+    while pending:
+        item = pending.pop()
+        if item[0] == "same":
+            append_hunk(hunks, "=", item[1])
+            continue
+        rows1, rows2 = item[1:]
+
+        # Take off the words the segment starts and ends with in both
+        # documents.
+        first1, first2 = rows1.start, rows2.start
+        while first1 < rows1.stop and first2 < rows2.stop and docs[0].box_text(first1) == docs[1].box_text(first2):
+            first1 += 1
+            first2 += 1
+        last1, last2 = rows1.stop, rows2.stop
+        while last1 > first1 and last2 > first2 and docs[0].box_text(last1-1) == docs[1].box_text(last2-1):
+            last1 -= 1
+            last2 -= 1
+        append_hunk(hunks, "=", docs[0].offset(first1) - docs[0].offset(rows1.start))
+        suffix_length = docs[0].offset(rows1.stop) - docs[0].offset(last1)
+
+        segment = (range(first1, last1), range(first2, last2))
+        lengths = [docs[idx].offset(segment[idx].stop) - docs[idx].offset(segment[idx].start) for idx in (0, 1)]
+        if lengths[0] == 0 or lengths[1] == 0:
+            # Nothing to diff: the segment is only in one document, or in
+            # neither.
+            segment_hunks = [("-", lengths[0]), ("+", lengths[1])]
+        elif budget.size is not None and sum(lengths) > budget.size:
+            anchors = align_unique_words(docs, segment[0], segment[1])
+            if len(anchors) > 0:
+                # Diff the smaller segments between the words that are
+                # unique within this one, and then the suffix.
+                pending.append(("same", suffix_length))
+                push_segments(pending, docs, segment[0], segment[1], anchors)
+                continue
+            segment_hunks = degrade_segment(docs, segment, lengths, budget, "size")
+        else:
+            t = time.perf_counter()
+            segment_hunks = diff_rows(docs, segment[0], segment[1], engine, timelimit=budget.time or 0)
+            if budget.time is not None and time.perf_counter() - t >= budget.time:
+                # diff_match_patch gave up and returned a rough diff.
+                segment_hunks = degrade_segment(docs, segment, lengths, budget, "time")
+        for op, oplen in segment_hunks:
+            append_hunk(hunks, op, oplen)
+        append_hunk(hunks, "=", suffix_length)
+    return hunks
+
+def push_segments(pending, docs, rows1, rows2, anchors):
+    # Add the segments of ranges of rows between the (row1, row2) anchors,
+    # and the anchor words themselves, to the work of
+    # perform_budgeted_diff.
+    items = []
+    rows = [rows1.start, rows2.start]
+    for row1, row2 in anchors:
+        items.append(("diff", range(rows[0], row1), range(rows[1], row2)))
+        items.append(("same", docs[0].textLength[row1]))
+        rows = [row1 + 1, row2 + 1]
+    items.append(("diff", range(rows[0], rows1.stop), range(rows[1], rows2.stop)))
+    pending.extend(reversed(items))
+
+def degrade_segment(docs, segment, lengths, budget, reason):
+    # Mark a segment as entirely changed and report it.
+    budget.degraded.append({
+        "reason": reason,
+        "pdfs": [
+            {
+                "file": docs[idx].pdf["file"],
+                "pages": [docs[idx].pages[docs[idx].page[segment[idx].start]]["number"],
+                          docs[idx].pages[docs[idx].page[segment[idx].stop-1]]["number"]],
+                "characters": lengths[idx],
+            }
+            for idx in (0, 1)
+        ],
+    })
+    return [("-", lengths[0]), ("+", lengths[1])]
+
+def align_unique_words(docs, rows1, rows2):
+    # Return (row1, row2) pairs of boxes whose text occurs exactly once in
+    # each range of rows, in order in both documents.
+    occurrences = {}
+    for idx, rows in ((0, rows1), (1, rows2)):
+        for row in rows:
+            occurrences.setdefault(docs[idx].box_text(row), ([], []))[idx].append(row)
+    unique_pairs = sorted((found1[0], found2[0]) for found1, found2 in occurrences.values()
+                          if len(found1) == 1 and len(found2) == 1)
+    return longest_increasing_pairs(unique_pairs)
+
+def perform_word_diff(doc1, doc2, rows1=None, rows2=None, timelimit=0):
+    # Diff two BoxStores word by word rather than character by character,
+    # which is much faster on long documents. Each distinct box text is
+    # mapped to a single character (a symbol) so that diff_match_patch can
+    # diff the documents as strings of symbols. The resulting hunks of
+    # symbols are then turned back into hunks of characters of the
+    # document text that process_hunks expects. rows1 and rows2 optionally
+    # restrict the diff to ranges of rows.
+    import diff_match_patch
+    if rows1 is None: rows1 = range(len(doc1))
+    if rows2 is None: rows2 = range(len(doc2))
+    symbols = {}
+    def encode(doc, rows):
+        return "".join(symbols.setdefault(doc.box_text(row), word_symbol(len(symbols)))
+                       for row in rows)
+    doc1symbols = encode(doc1, rows1)
+    doc2symbols = encode(doc2, rows2)
+    hunks = diff_match_patch.diff(
+        doc1symbols,
+        doc2symbols,
+        timelimit=timelimit,
         checklines=False)
+    return word_hunks_to_char_hunks(hunks, doc1, doc2, rows1.start, rows2.start)
+
+def word_symbol(n):
+    # Map the n'th distinct word to a character, skipping NUL (which the
+    # diff library can't handle) and the surrogate code points. Words
+    # beyond the Basic Multilingual Plane are only used where the diff
+    # library counts them as a single character.
+    n += 1
+    if n >= 0xD800:
+        n += 0x800
+    if n > 0xFFFF and not diff_library_has_wide_chars():
+        raise ValueError("Too many distinct words for the word diff engine.")
+    return chr(n)
+
+@lru_cache(maxsize=None)
+def diff_library_has_wide_chars():
+    import diff_match_patch
+    return diff_match_patch.diff("", "\U00010000", timelimit=0, checklines=False) == [("+", 1)]
+
+def word_hunks_to_char_hunks(hunks, doc1, doc2, row1=0, row2=0):
+    # Convert (op, number of boxes) hunks, starting at the given rows,
+    # into (op, number of characters) hunks.
+    docs = (doc1, doc2)
+    rows = [row1, row2]
+    char_hunks = []
+    for op, oplen in hunks:
+        idx = 1 if op == "+" else 0
+        length = docs[idx].offset(rows[idx] + oplen) - docs[idx].offset(rows[idx])
+        rows[idx] += oplen
+        if op == "=":
+            rows[1] += oplen
+        append_hunk(char_hunks, op, length)
+    return char_hunks
+
+def append_hunk(hunks, op, length):
+    # Add a hunk to a list of hunks, dropping empty hunks and merging
+    # hunks with the same op that become adjacent.
+    if length == 0:
+        return
+    if len(hunks) > 0 and hunks[-1][0] == op:
+        hunks[-1] = (op, hunks[-1][1] + length)
+    else:
+        hunks.append((op, length))
+
+def perform_page_anchored_diff(docs, engine, budget=None):
+    # Diff two BoxStores by first lining up the pages whose text is the
+    # same in both documents, and then diffing only the text between
+    # those pages. When only a few pages changed, the time this takes
+    # depends on the size of the changes and not of the documents.
+    pages = [doc.page_rows() for doc in docs]
+    anchors = align_pages(docs, pages)
+
+    # Emit the hunks for the stretches of text between the anchors and
+    # for the anchor pages themselves.
+    hunks = []
+    rows = [0, 0]
+    for page1, page2 in anchors + [(None, None)]:
+        if page1 is not None:
+            gap = (range(rows[0], pages[0][page1].start), range(rows[1], pages[1][page2].start))
+        else:
+            gap = (range(rows[0], len(docs[0])), range(rows[1], len(docs[1])))
+        if len(gap[0]) > 0 or len(gap[1]) > 0:
+            for op, oplen in diff_rows(docs, gap[0], gap[1], engine, budget):
+                append_hunk(hunks, op, oplen)
+        if page1 is None:
+            break
+
+        append_hunk(hunks, "=", docs[0].offset(pages[0][page1].stop) - docs[0].offset(pages[0][page1].start))
+        rows = [pages[0][page1].stop, pages[1][page2].stop]
+    return hunks
+
+def align_pages(docs, pages):
+    # Line up the pages in two BoxStores whose text is identical. Returns
+    # a list of (page1, page2) pairs of rows in the page tables, in order
+    # in both documents.
+    #
+    # Pages whose text occurs exactly once in each document are paired up
+    # first, keeping the longest sequence of pairs that is in the same
+    # order in both documents. Then the anchors are extended to the
+    # neighboring pages, as in a patience diff.
+    def fingerprint(doc, rows):
+        # Pages without text aren't used as anchors.
+        text = doc.text[doc.offset(rows.start):doc.offset(rows.stop)]
+        return hashlib.sha1(text.encode("utf8")).digest() if text else None
+    fingerprints = [[fingerprint(doc, rows) for rows in doc_pages]
+                    for doc, doc_pages in zip(docs, pages)]
+
+    occurrences = {}
+    for idx in (0, 1):
+        for page, fingerprint in enumerate(fingerprints[idx]):
+            if fingerprint is None: continue
+            occurrences.setdefault(fingerprint, ([], []))[idx].append(page)
+    unique_pairs = sorted((pages1[0], pages2[0]) for pages1, pages2 in occurrences.values()
+                          if len(pages1) == 1 and len(pages2) == 1)
+    anchors = longest_increasing_pairs(unique_pairs)
+
+    # Extend each anchor forward and backward over pages that are the same
+    # in both documents.
+    def same(page1, page2):
+        return fingerprints[0][page1] is not None and fingerprints[0][page1] == fingerprints[1][page2]
+    extended = []
+    bounds = [(-1, -1)] + anchors + [(len(pages[0]), len(pages[1]))]
+    for (prev1, prev2), (next1, next2) in zip(bounds, bounds[1:]):
+        # Extend the previous anchor forward into the gap...
+        forward = []
+        page1, page2 = prev1 + 1, prev2 + 1
+        while page1 < next1 and page2 < next2 and same(page1, page2):
+            forward.append((page1, page2))
+            page1 += 1
+            page2 += 1
+
+        # ...and the next anchor backward into what's left of it.
+        backward = []
+        end1, end2 = next1 - 1, next2 - 1
+        while end1 >= page1 and end2 >= page2 and same(end1, end2):
+            backward.append((end1, end2))
+            end1 -= 1
+            end2 -= 1
+
+        extended += forward + backward[::-1]
+        if next1 < len(pages[0]):
+            extended.append((next1, next2))
+
+    return extended
+
+def longest_increasing_pairs(pairs):
+    # Given (a, b) pairs sorted by a with distinct a's and b's, return the
+    # longest subsequence in which b is increasing too.
+    tails = [] # tails[k] is the index of the pair ending the best subsequence of length k+1
+    tail_values = []
+    previous = [None] * len(pairs)
+    for i, (a, b) in enumerate(pairs):
+        k = bisect_left(tail_values, b)
+        if k > 0:
+            previous[i] = tails[k-1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(b)
+        else:
+            tails[k] = i
+            tail_values[k] = b
+    result = []
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.append(pairs[i])
+        i = previous[i]
+    return result[::-1]
 
 def process_hunks(hunks, boxes):
     # Process each diff hunk one by one and look at their corresponding
-    # text boxes in the original PDFs.
+    # text boxes in the original PDFs, given as BoxStores. The changed
+    # boxes are returned as (pdf index, row) references.
     offsets = [0, 0]
     changes = []
+
+    # The boxes of each document are consumed in order. cursors holds the
+    # index of the first box in each document that hasn't been consumed yet.
+    # Since the text of the boxes is contiguous, the start and end offsets
+    # of the boxes are sorted and we can bisect them to find the boxes that
+    # a hunk touches. The caller's lists are not modified.
+    cursors = [0, 0]
+    starts = [doc_boxes.startIndex for doc_boxes in boxes]
+    ends = [doc_boxes.ends() for doc_boxes in boxes]
+
     for op, oplen in hunks:
         if op == "=":
             # This hunk represents a region in the two text documents that are
@@ -147,7 +698,7 @@ def process_hunks(hunks, boxes):
             # or right (op == "+") document. The change is oplen chars long.
             idx = 0 if (op == "-") else 1
 
-            mark_difference(oplen, offsets[idx], boxes[idx], changes)
+            cursors[idx] = mark_difference(oplen, offsets[idx], boxes[idx], starts[idx], ends[idx], cursors[idx], changes)
 
             offsets[idx] += oplen
 
@@ -155,8 +706,8 @@ def process_hunks(hunks, boxes):
             # mark the position where that text may have been to indicate an
             # insertion.
             idx2 = 1 - idx
-            mark_difference(1, offsets[idx2]-1, boxes[idx2], changes)
-            mark_difference(0, offsets[idx2]+0, boxes[idx2], changes)
+            cursors[idx2] = mark_difference(1, offsets[idx2]-1, boxes[idx2], starts[idx2], ends[idx2], cursors[idx2], changes)
+            cursors[idx2] = mark_difference(0, offsets[idx2]+0, boxes[idx2], starts[idx2], ends[idx2], cursors[idx2], changes)
 
         else:
             raise ValueError(op)
@@ -167,34 +718,45 @@ def process_hunks(hunks, boxes):
 
     return changes
 
-def mark_difference(hunk_length, offset, boxes, changes):
+def mark_difference(hunk_length, offset, boxes, starts, ends, cursor, changes):
   # We're passed an offset and length into a document given to us
   # by the text comparison, and we'll mark the text boxes passed
-  # in boxes as having changed content.
+  # in the BoxStore boxes as having changed content. starts and ends are the
+  # text offsets where each box starts and ends, and boxes before
+  # cursor have already been consumed. Returns the new cursor.
 
-  # Discard boxes whose text is entirely before this hunk
-  while len(boxes) > 0 and (boxes[0]["startIndex"] + boxes[0]["textLength"]) <= offset:
-    boxes.pop(0)
+  # Skip boxes whose text is entirely before this hunk
+  cursor = bisect_right(ends, offset, cursor)
 
   # Process the boxes that intersect this hunk. We can't subdivide boxes,
   # so even though not all of the text in the box might be changed we'll
-  # mark the whole box as changed.
-  while len(boxes) > 0 and boxes[0]["startIndex"] < offset + hunk_length:
-    # Mark this box as changed. Discard the box. Now that we know it's changed,
-    # there's no reason to hold onto it. It can't be marked as changed twice.
-    changes.append(boxes.pop(0))
+  # mark the whole box as changed. Consume the boxes. Now that we know
+  # they're changed, they can't be marked as changed twice.
+  end = bisect_left(starts, offset + hunk_length, cursor)
+  changes.extend((boxes.pdf["index"], row) for row in range(cursor, end))
+  return end
 
 # Turns a JSON object of PDF changes into a PIL image object.
-def render_changes(changes, styles,width):
+def render_changes(changes, styles,width, workers=1, cache=None, region_only=False, low_memory=False):
     # Merge sequential boxes to avoid sequential disjoint rectangles.
 
     changes = simplify_changes(changes)
     if len(changes) == 0:
         raise Exception("There are no text differences.")
 
-    # Make images for all of the pages named in changes.
+    # Make images for all of the pages named in changes. With region_only,
+    # only the band of each page that contains its changes is rasterized.
+
+    regions = change_regions(changes, width) if region_only else None
+    with profiling.stage("rasterize"):
+        pages = make_pages_images(changes,width, workers, cache, regions, low_memory)
+
+    # With low_memory, the pages are ink images (see png_to_image), and
+    # the bounding box of the content of each page is found once here and
+    # then kept up to date as the pages are split and marked rather than
+    # found again from the images when cropping.
 
-    pages = make_pages_images(changes,width)
+    bboxes = content_bboxes(pages) if low_memory else None
 
     # Convert the box coordinates (PDF coordinates) into image coordinates.
     # Then set change["page"] = change["page"]["number"] so that we don't
@@ -202,112 +764,442 @@ def render_changes(changes, styles,width):
     # numbers).
     for change in changes:
         if change == "*": continue
-        im = pages[change["pdf"]["index"]][change["page"]["number"]]
-        change["x"] *= im.size[0]/change["page"]["width"]
-        change["y"] *= im.size[1]/change["page"]["height"]
-        change["width"] *= im.size[0]/change["page"]["width"]
-        change["height"] *= im.size[1]/change["page"]["height"]
+        if regions is not None:
+            # The image is a band of rows of the page raster.
+            raster_width, raster_height, top, bottom = regions[change["pdf"]["index"]][change["page"]["number"]]
+        else:
+            im = pages[change["pdf"]["index"]][change["page"]["number"]]
+            raster_width, raster_height = im.size
+            top = 0
+        change["x"] *= raster_width/change["page"]["width"]
+        change["y"] *= raster_height/change["page"]["height"]
+        change["y"] -= top
+        change["width"] *= raster_width/change["page"]["width"]
+        change["height"] *= raster_height/change["page"]["height"]
         change["page"] = change["page"]["number"]
 
     # To facilitate seeing how two corresponding pages align, we will
     # break up pages into sub-page images and insert whitespace between
     # them.
 
-    page_groups = realign_pages(pages, changes)
+    with profiling.stage("realign_pages"):
+        page_groups = realign_pages(pages, changes, bboxes)
 
     # Draw red rectangles.
 
-    draw_red_boxes(changes, pages, styles)
+    with profiling.stage("draw_red_boxes"):
+        draw_red_boxes(changes, pages, styles, bboxes)
 
     # Zealous crop to make output nicer. We do this after
     # drawing rectangles so that we don't mess up coordinates.
 
-    zealous_crop(page_groups)
+    with profiling.stage("zealous_crop"):
+        zealous_crop(page_groups, bboxes)
 
-    # Stack all of the changed pages into a final PDF.
+    # Stack all of the changed pages into a final PDF. Ink images are
+    # converted to color only as they are pasted in.
 
-    img = stack_pages(page_groups)
+    with profiling.stage("stack_pages"):
+        img = stack_pages(page_groups, "RGB" if low_memory else "RGBA")
 
     return img
 
-def make_pages_images(changes,width):
+def render_change_groups(changes, styles, width, workers=1, cache=None, region_only=False, low_memory=False):
+    # Like render_changes, but rather than stacking all of the pages into
+    # one image, yield an image for each group of pages that line up as
+    # soon as it is finished. Pages are rasterized when the first group
+    # that shows them is reached and are dropped once shown, so only about
+    # one group's pages are in memory at a time. Since each image is
+    # finished on its own, the pages are cropped horizontally group by
+    # group rather than all the same.
+
+    changes = simplify_changes(changes)
+    if len(changes) == 0:
+        raise Exception("There are no text differences.")
+
+    regions = change_regions(changes, width) if region_only else None
+
+    # Convert the box coordinates into image coordinates as render_changes
+    # does, but from the size pdftoppm will make each page since the pages
+    # aren't rasterized yet. Remember a change on each page to rasterize
+    # the page from later.
+    unrasterized = [{}, {}]
+    for change in changes:
+        if change == "*": continue
+        pdf_index = change["pdf"]["index"]
+        unrasterized[pdf_index].setdefault(change["page"]["number"], { "pdf": change["pdf"], "page": change["page"] })
+        if regions is not None:
+            raster_width, raster_height, top, bottom = regions[pdf_index][change["page"]["number"]]
+        else:
+            raster_width, raster_height = raster_size(change["page"], width)
+            top = 0
+        change["x"] *= raster_width/change["page"]["width"]
+        change["y"] *= raster_height/change["page"]["height"]
+        change["y"] -= top
+        change["width"] *= raster_width/change["page"]["width"]
+        change["height"] *= raster_height/change["page"]["height"]
+        change["page"] = change["page"]["number"]
+
+    # Plan the sub-pages and their groups as realign_pages does.
+    with profiling.stage("realign_pages"):
+        splits = split_pages(changes)
+        page_groups = group_pages(changes)
+    page_changes = { }
+    for change in changes:
+        if change == "*": continue
+        page_changes.setdefault((change["pdf"]["index"], change["page"]), []).append(change)
+
+    sub_pages = [{}, {}]
+    sub_bboxes = [{}, {}]
+    for group in page_groups:
+        if len(group[0]) == 0 and len(group[1]) == 0: continue
+
+        # Rasterize the pages first shown in this group and split them into
+        # their sub-pages.
+        first_shown = []
+        for pdf_index in (0, 1):
+            for page, split_index in group[pdf_index]:
+                if page in unrasterized[pdf_index]:
+                    first_shown.append(unrasterized[pdf_index].pop(page))
+        with profiling.stage("rasterize"):
+            pages = make_pages_images(first_shown, width, workers, cache, regions, low_memory)
+        bboxes = content_bboxes(pages) if low_memory else None
+        with profiling.stage("realign_pages"):
+            for pdf_index in (0, 1):
+                for page, im in pages[pdf_index].items():
+                    page_splits = splits.get((pdf_index, page), [])
+                    for split_index, sub_page in enumerate(split_page_image(im, page_splits)):
+                        sub_pages[pdf_index][(page, split_index)] = sub_page
+                    if low_memory:
+                        for split_index, bbox in enumerate(split_bbox(bboxes[pdf_index][page], page_splits, im.size[1])):
+                            sub_bboxes[pdf_index][(page, split_index)] = bbox
+        del pages
+
+        grp = tuple({ page: sub_pages[pdf_index].pop(page) for page in group[pdf_index] } for pdf_index in (0, 1))
+        grp_bboxes = [{ page: sub_bboxes[pdf_index].pop(page) for page in group[pdf_index] } for pdf_index in (0, 1)] if low_memory else None
+        with profiling.stage("draw_red_boxes"):
+            draw_red_boxes([change for pdf_index in (0, 1) for page in group[pdf_index] for change in page_changes[(pdf_index, page)]],
+                           grp, styles, grp_bboxes)
+        with profiling.stage("zealous_crop"):
+            zealous_crop([grp], grp_bboxes)
+        with profiling.stage("stack_pages"):
+            img = stack_pages([grp], "RGB" if low_memory else "RGBA")
+        yield img
+
+def save_change_groups(images, fn, format):
+    # Write the images of render_change_groups as each is made: as the
+    # pages of one file for the tiff and pdf formats (fn may also be a
+    # binary file object for pdf), or else each to its own file, named by
+    # replacing %d in fn with its number.
+    if format == "tiff":
+        with TiffImagePlugin.AppendingTiffWriter(fn, new=True) as tf:
+            for img in images:
+                img.save(tf, "TIFF")
+                tf.newFrame()
+    elif format == "pdf":
+        f = open(fn, "wb") if isinstance(fn, str) else fn
+        try:
+            with PdfImageWriter(f) as pdf:
+                for img in images:
+                    pdf.add_page(img)
+        finally:
+            if f is not fn:
+                f.close()
+    else:
+        for i, img in enumerate(images):
+            img.save(fn % (i+1), format.upper())
+
+# pdftoppm parses the whole PDF each time it is run, so it is cheaper to
+# rasterize a few unneeded pages than to run it again for the pages after
+# them.
+RASTER_MAX_GAP = 2
+
+# In region-only rendering, a run of pdftoppm rasterizes the union of the
+# bands of its pages on each of its pages, so pages whose changes are at
+# different heights are only put in the same run if at most this
+# fraction of the rows it rasterizes are outside the pages' own bands.
+RASTER_MAX_WASTE = .5
+
+def make_pages_images(changes,width, workers=1, cache=None, regions=None, ink=False):
+    # Rasterize the pages named in changes. The pages of each PDF are
+    # rendered by as few runs of pdftoppm as possible. With more than one
+    # worker, the runs are split into chunks that are rendered in parallel
+    # for both PDFs at once. If a DiskCache is given, rasters are looked up
+    # in and saved to it.
+    #
+    # If regions (from change_regions) is given, only the band of rows of
+    # each page given there is rasterized. These partial rasters depend
+    # on where the changes are, so they aren't cached.
+    #
+    # With ink, pages are rasterized in grayscale and returned as ink
+    # images (see png_to_image).
+    if regions is not None:
+        cache = None
+    files = [None, None]
     pages = [{}, {}]
     for change in changes:
         if change == "*": continue # not handled yet
         pdf_index = change["pdf"]["index"]
-        pdf_page = change["page"]["number"]
-        if pdf_page not in pages[pdf_index]:
-            pages[pdf_index][pdf_page] = pdftopng(change["pdf"]["file"], pdf_page,width)
+        files[pdf_index] = change["pdf"]["file"]
+        pages[pdf_index].setdefault(change["page"]["number"], None)
+
+    cache_keys = [{}, {}]
+    jobs = []
+    for pdf_index in (0, 1):
+        if cache is not None and len(pages[pdf_index]) > 0:
+            digest = file_digest(files[pdf_index])
+            for pdf_page in pages[pdf_index]:
+                cache_keys[pdf_index][pdf_page] = raster_cache_key(digest, pdf_page, width, ink)
+                pngbytes = cache.get("rasters", cache_keys[pdf_index][pdf_page])
+                if pngbytes is not None:
+                    profiling.count("raster_cache_hits", 1)
+                    pages[pdf_index][pdf_page] = png_to_image(pngbytes, ink)
+        missing = sorted(pdf_page for pdf_page, im in pages[pdf_index].items() if im is None)
+        # One run of pdftoppm crops all of its pages the same way, so with
+        # regions, pages with different raster sizes go in different runs,
+        # and so do pages whose bands are far apart.
+        raster_sizes = { pdf_page: regions[pdf_index][pdf_page][0:2] for pdf_page in missing } if regions is not None else None
+        bands = { pdf_page: regions[pdf_index][pdf_page][2:4] for pdf_page in missing } if regions is not None else None
+        for pages_run in raster_runs(missing, -(-len(missing) // workers), raster_sizes, bands):
+            jobs.append((pdf_index, pages_run))
+        profiling.count("pages_rasterized", len(missing))
+
+    with tempfile.TemporaryDirectory(prefix="pdf-diff-") as tmpdir:
+        def rasterize(job):
+            pdf_index, pages_run = job
+            prefix = os.path.join(tmpdir, "%d-%d" % (pdf_index, pages_run[0]))
+            if regions is None:
+                pngs = pdftopngs(files[pdf_index], pages_run[0], pages_run[-1], width, prefix, gray=ink)
+                return [(pdf_index, pdf_page, pngs[pdf_page], png_to_image(pngs[pdf_page], ink))
+                        for pdf_page in pages_run]
+
+            # Rasterize the union of the bands of the pages in the run, and
+            # then cut out each page's own band.
+            run_regions = [regions[pdf_index][pdf_page] for pdf_page in pages_run]
+            raster_width = run_regions[0][0]
+            top = min(region[2] for region in run_regions)
+            bottom = max(region[3] for region in run_regions)
+            pngs = pdftopngs(files[pdf_index], pages_run[0], pages_run[-1], width, prefix,
+                             crop=(0, top, raster_width, bottom-top), gray=ink)
+            result = []
+            for pdf_page, region in zip(pages_run, run_regions):
+                im = png_to_image(pngs[pdf_page], ink)
+                result.append((pdf_index, pdf_page, None, im.crop((0, region[2]-top, im.size[0], region[3]-top))))
+            return result
+
+        if workers > 1 and len(jobs) > 1:
+            with ThreadPoolExecutor(workers) as executor:
+                results = list(executor.map(rasterize, jobs))
+        else:
+            results = map(rasterize, jobs)
+
+        for result in results:
+            for pdf_index, pdf_page, pngbytes, im in result:
+                pages[pdf_index][pdf_page] = im
+                if cache is not None:
+                    cache.put("rasters", cache_keys[pdf_index][pdf_page], pngbytes)
+
     return pages
 
-def realign_pages(pages, changes):
+def raster_cache_key(digest, pdf_page, width, ink=False):
+    # The key of a page raster in a DiskCache.
+    return cache_key("raster", digest, pdf_page, width, *(["gray"] if ink else []))
+
+def raster_runs(pdf_pages, max_pages, raster_sizes=None, bands=None):
+    # Group sorted page numbers into runs that are rendered by one run of
+    # pdftoppm each. A run has at most max_pages of the given pages, and
+    # gaps of at most RASTER_MAX_GAP unneeded pages. If raster_sizes is
+    # given, it maps the pages to values that must be equal within a run.
+    # If bands is given, it maps the pages to the (top, bottom) rows that
+    # are needed of them, and a run's pages are rasterized from the top of
+    # the highest band to the bottom of the lowest one, wasting at most
+    # RASTER_MAX_WASTE of the rows.
+    runs = []
+    run_band = None # the (top, bottom, needed rows) of the last run
+    for pdf_page in pdf_pages:
+        joins = len(runs) > 0 and len(runs[-1]) < max_pages and pdf_page - runs[-1][-1] <= RASTER_MAX_GAP + 1 \
+            and (raster_sizes is None or raster_sizes[pdf_page] == raster_sizes[runs[-1][0]])
+        if bands is not None:
+            top, bottom = bands[pdf_page]
+            if joins:
+                joined_band = (min(top, run_band[0]), max(bottom, run_band[1]), run_band[2] + bottom - top)
+                rasterized_rows = (pdf_page - runs[-1][0] + 1) * (joined_band[1] - joined_band[0])
+                joins = joined_band[2] >= (1 - RASTER_MAX_WASTE) * rasterized_rows
+            run_band = joined_band if joins else (top, bottom, bottom - top)
+        if joins:
+            runs[-1].append(pdf_page)
+        else:
+            runs.append([pdf_page])
+    return runs
+
+# In region-only rendering, how much of the page to rasterize above and
+# below the changes, as a fraction of the page height.
+REGION_PADDING = .03
+
+def change_regions(changes, width):
+    # Find the band of each page that contains its changes. Returns
+    # regions[pdf index][page number] = (raster width, raster height,
+    # top, bottom), where the raster size is the size of the whole page
+    # as rasterized by pdftoppm at the given width and top and bottom are
+    # the rows of the band.
+    regions = [{}, {}]
+    for change in changes:
+        if change == "*": continue
+        page = change["page"]
+        raster_width, raster_height = raster_size(page, width)
+        top = change["y"] * raster_height / page["height"]
+        bottom = (change["y"] + change["height"]) * raster_height / page["height"]
+        region = regions[change["pdf"]["index"]].get(page["number"])
+        if region is not None:
+            top = min(top, region[2])
+            bottom = max(bottom, region[3])
+        regions[change["pdf"]["index"]][page["number"]] = (raster_width, raster_height, top, bottom)
+
+    for pdf_regions in regions:
+        for pdf_page, (raster_width, raster_height, top, bottom) in pdf_regions.items():
+            padding = REGION_PADDING * raster_height
+            pdf_regions[pdf_page] = (raster_width, raster_height,
+                max(0, int(math.floor(top - padding))),
+                min(raster_height, int(math.ceil(bottom + padding))))
+    return regions
+
+def raster_size(page, width):
+    # The size of the image pdftoppm -scale-to makes of a page: the longer
+    # side of the page is scaled to width.
+    scale = width / max(page["width"], page["height"])
+    return int(math.ceil(page["width"] * scale)), int(math.ceil(page["height"] * scale))
+
+def realign_pages(pages, changes, bboxes=None):
     # Split pages into sub-page images at locations of asterisks
-    # in the changes where no boxes will cross the split point.
+    # in the changes where no boxes will cross the split point. If
+    # bboxes (from content_bboxes) is given, it is updated the same way.
+    splits = split_pages(changes)
     for pdf in (0, 1):
         for page in list(pages[pdf]): # clone before modifying
             # Re-do all of the page "numbers" to be a tuple of
-            # (page, split).
-            split_index = 0
-            pg = pages[pdf][page]
-            del pages[pdf][page]
-            pages[pdf][(page, split_index)] = pg
-            for box in changes:
-                if box != "*" and box["pdf"]["index"] == pdf and box["page"] == page:
-                    box["page"] = (page, 0)
-
-            # Look for places to split.
-            for i, box in enumerate(changes):
-                if box != "*": continue
-
-                # This is a "*" marker, indicating this is a place where the left
-                # and right pages line up. Get the lowest y coordinate of a change
-                # above this point and the highest y coordinate of a change after
-                # this point. If there's no overlap, we can split the PDF here.
-                try:
-                    y1 = max(b["y"]+b["height"] for j, b in enumerate(changes)
-                        if j < i and b != "*" and b["pdf"]["index"] == pdf and b["page"] == (page, split_index))
-                    y2 = min(b["y"] for j, b in enumerate(changes)
-                        if j > i and b != "*" and b["pdf"]["index"] == pdf and b["page"] == (page, split_index))
-                except ValueError:
-                    # Nothing either before or after this point, so no need to split.
-                    continue
-                if y1+1 >= y2:
-                    # This is not a good place to split the page.
-                    continue
-
-                # Split the PDF page between the bottom of the previous box and
-                # the top of the next box.
-                split_coord = int(round((y1+y2)/2))
-
-                # Make a new image for the next split-off part.
-                im = pages[pdf][(page, split_index)]
-                pages[pdf][(page, split_index)] = im.crop([0, 0, im.size[0], split_coord ])
-                pages[pdf][(page, split_index+1)] = im.crop([0, split_coord, im.size[0], im.size[1] ])
-
-                # Re-do all of the coordinates of boxes after the split point:
-                # map them to the newly split-off part.
-                for j, b in enumerate(changes):
-                    if j > i and b != "*" and b["pdf"]["index"] == pdf and b["page"] == (page, split_index):
-                        b["page"] = (page, split_index+1)
-                        b["y"] -= split_coord
-                split_index += 1
+            # (page, split), cutting the image at each split coordinate.
+            im = pages[pdf].pop(page)
+            for split_index, sub_page in enumerate(split_page_image(im, splits.get((pdf, page), []))):
+                pages[pdf][(page, split_index)] = sub_page
+            if bboxes is not None:
+                for split_index, bbox in enumerate(split_bbox(bboxes[pdf].pop(page), splits.get((pdf, page), []), im.size[1])):
+                    bboxes[pdf][(page, split_index)] = bbox
 
     # Re-group the pages by where we made a split on both sides.
-    page_groups = [({}, {})]
-    for i, box in enumerate(changes):
-        if box != "*":
-            page_groups[-1][ box["pdf"]["index"] ][ box["page"] ] = pages[box["pdf"]["index"]][box["page"]]
+    return [
+        tuple({ page: pages[pdf][page] for page in group[pdf] } for pdf in (0, 1))
+        for group in group_pages(changes)
+    ]
+
+def split_pages(changes):
+    # Find where to split each page and relabel the changes with the
+    # (page, split) they fall on, moving their coordinates to be relative
+    # to the top of that split. Returns a dict mapping (pdf index, page) to
+    # the y coordinates of the splits, relative to the whole page.
+    #
+    # A "*" marker is a place where the left and right pages line up. A
+    # page can be split at a marker if the changes on the page before it
+    # end above where the changes on the page after it begin. Rather than
+    # scanning all of the changes at each marker, this walks each page's
+    # changes once, with the running maximum bottom of the changes since
+    # the last split and a table of the minimum top of the remaining ones.
+    markers = [i for i, change in enumerate(changes) if change == "*"]
+    positions = { }
+    for i, change in enumerate(changes):
+        if change == "*": continue
+        positions.setdefault((change["pdf"]["index"], change["page"]), []).append(i)
+
+    splits = { }
+    for (pdf, page), rows in positions.items():
+        # The minimum y coordinate of the changes from each one onward.
+        tops = [changes[i]["y"] for i in rows]
+        for k in range(len(tops) - 2, -1, -1):
+            tops[k] = min(tops[k], tops[k+1])
+
+        split_index = 0
+        offset = 0 # the y coordinate of the current split on the page
+        y1 = None # the bottom of the changes since the last split
+        for k, i in enumerate(rows):
+            box = changes[i]
+            box["page"] = (page, split_index)
+            box["y"] -= offset
+            y1 = box["y"]+box["height"] if y1 is None else max(y1, box["y"]+box["height"])
+
+            # Is there a marker between this change and the next one on
+            # the page? If there are several, they all see the same changes
+            # before and after them, so only the first matters.
+            if k == len(rows) - 1 or bisect_right(markers, i) == bisect_left(markers, rows[k+1]):
+                continue
+            y2 = tops[k+1] - offset
+            if y1+1 >= y2:
+                # This is not a good place to split the page.
+                continue
+
+            # Split the page between the bottom of the previous box and
+            # the top of the next box.
+            split_coord = int(round((y1+y2)/2))
+            offset += split_coord
+            splits.setdefault((pdf, page), []).append(offset)
+            split_index += 1
+            y1 = None
+
+    return splits
+
+def split_page_image(im, splits):
+    # Cut a page image at the y coordinates of its splits.
+    coords = [0] + splits + [im.size[1]]
+    return [im.crop([0, coords[i], im.size[0], coords[i+1]]) for i in range(len(coords) - 1)]
+
+def split_bbox(bbox, splits, height):
+    # Cut a bounding box of the content of a page at the y coordinates of
+    # its splits, giving the part in each split relative to its top, or
+    # None if there is none.
+    coords = [0] + splits + [height]
+    sub_bboxes = []
+    for top, bottom in zip(coords[:-1], coords[1:]):
+        if bbox is None or bbox[3] <= top or bbox[1] >= bottom:
+            sub_bboxes.append(None)
         else:
-            # Did we split at this location?
-            pages_before = set((b["pdf"]["index"], b["page"]) for j, b in enumerate(changes) if j < i and b != "*")
-            pages_after = set((b["pdf"]["index"], b["page"]) for j, b in enumerate(changes) if j > i and b != "*")
-            if len(pages_before & pages_after) == 0:
-                # no page is on both sides of this asterisk, so start a new group
-                page_groups.append( ({}, {}) )
-    return page_groups
+            sub_bboxes.append((bbox[0], max(bbox[1], top) - top, bbox[2], min(bbox[3], bottom) - top))
+    return sub_bboxes
+
+def content_bboxes(pages):
+    # Find the bounding box of the content of each ink image (by [pdf
+    # index][page]). Blank paper is zero in an ink image, so this is just
+    # getbbox.
+    return [{ page: im.getbbox() for page, im in pdf_pages.items() } for pdf_pages in pages]
+
+def group_pages(changes):
+    # Group the (relabeled) pages of the changes, starting a new group at
+    # each "*" marker that no page spans, i.e. where there is a split on
+    # both sides. Returns a list of pairs of lists of pages.
+    #
+    # Count, at each position, how many pages have changes both before
+    # and after it, using the first and last position of each page.
+    spans = { }
+    for i, change in enumerate(changes):
+        if change == "*": continue
+        key = (change["pdf"]["index"], change["page"])
+        spans[key] = (spans[key][0], i) if key in spans else (i, i)
+    crossing = [0] * (len(changes) + 1)
+    for first, last in spans.values():
+        crossing[first+1] += 1
+        crossing[last] -= 1
 
-def draw_red_boxes(changes, pages, styles):
-    # Draw red boxes around changes.
+    page_groups = [({}, {})]
+    count = 0
+    for i, change in enumerate(changes):
+        count += crossing[i]
+        if change != "*":
+            page_groups[-1][ change["pdf"]["index"] ][ change["page"] ] = None
+        elif count == 0:
+            # no page is on both sides of this asterisk, so start a new group
+            page_groups.append( ({}, {}) )
+    return [tuple(list(group[pdf]) for pdf in (0, 1)) for group in page_groups]
+
+def draw_red_boxes(changes, pages, styles, bboxes=None):
+    # Draw red boxes around changes. If bboxes is given, the bounding
+    # boxes of the content of the pages are extended to include them.
 
     for change in changes:
         if change == "*": continue # not handled yet
@@ -339,17 +1231,33 @@ def draw_red_boxes(changes, pages, styles):
 
         del draw
 
-def zealous_crop(page_groups):
+        if bboxes is not None:
+            mark = (max(0, int(math.floor(change["x"]))), max(0, int(math.floor(change["y"]))),
+                    min(im.size[0], int(math.floor(change["x"]+change["width"]))+1), min(im.size[1], int(math.floor(change["y"]+change["height"]))+1))
+            bbox = bboxes[change["pdf"]["index"]][change["page"]]
+            if bbox is not None:
+                mark = (min(mark[0], bbox[0]), min(mark[1], bbox[1]), max(mark[2], bbox[2]), max(mark[3], bbox[3]))
+            if mark[0] < mark[2] and mark[1] < mark[3]:
+                bboxes[change["pdf"]["index"]][change["page"]] = mark
+
+def zealous_crop(page_groups, bboxes=None):
     # Zealous crop all of the pages. Vertical margins can be cropped
     # however, but be sure to crop all pages the same horizontally.
+    # If bboxes is given, it has the bounding box of the content of each
+    # page, which is otherwise found from the images.
+    def content_bbox(idx, pg, im):
+        if bboxes is not None:
+            return bboxes[idx][pg]
+        return ImageOps.invert(im.convert("L")).getbbox() # .invert() requires a grayscale image
+
     for idx in (0, 1):
         # min horizontal extremes
         minx = None
         maxx = None
         width = None
         for grp in page_groups:
-            for pdf in grp[idx].values():
-                bbox = ImageOps.invert(pdf.convert("L")).getbbox()
+            for pg, pdf in grp[idx].items():
+                bbox = content_bbox(idx, pg, pdf)
                 if bbox is None: continue # empty
                 minx = min(bbox[0], minx) if minx is not None else bbox[0]
                 maxx = max(bbox[2], maxx) if maxx is not None else bbox[2]
@@ -361,7 +1269,7 @@ def zealous_crop(page_groups):
         for grp in page_groups:
             for pg in grp[idx]:
                 im = grp[idx][pg]
-                bbox = ImageOps.invert(im.convert("L")).getbbox() # .invert() requires a grayscale image
+                bbox = content_bbox(idx, pg, im)
                 if bbox is None: bbox = [0, 0, im.size[0], im.size[1]] # empty page
                 vpad = int(.02*im.size[1])
                 im = im.crop( (0, max(0, bbox[1]-vpad), im.size[0], min(im.size[1], bbox[3]+vpad) ) )
@@ -369,7 +1277,7 @@ def zealous_crop(page_groups):
                     im = im.crop( (minx, 0, maxx, im.size[1]) )
                 grp[idx][pg] = im
 
-def stack_pages(page_groups):
+def stack_pages(page_groups, mode="RGBA"):
     # Compute the dimensions of the final image.
     col_height = [0, 0]
     col_width = 0
@@ -389,7 +1297,7 @@ def stack_pages(page_groups):
     height = max(col_height)
 
     # Draw image with some background lines.
-    img = Image.new("RGBA", (col_width*2+1, height), "#F3F3F3")
+    img = Image.new(mode, (col_width*2+1, height), "#F3F3F3")
     draw = ImageDraw.Draw(img)
     for x in range(0, col_width*2+1, 50):
         draw.line( (x, 0, x, img.size[1]), fill="#E3E3E3")
@@ -417,11 +1325,14 @@ def stack_pages(page_groups):
 
     return img
 
-def simplify_changes(boxes):
+def simplify_changes(boxes, docs=None):
     # Combine changed boxes when they were sequential in the input.
     # Our bounding boxes may be on a word-by-word basis, which means
     # neighboring boxes will lead to discontiguous rectangles even
     # though they are probably the same semantic change.
+    if docs is not None:
+        return simplify_change_refs(boxes, docs)
+
     changes = []
     for b in boxes:
         if len(changes) > 0 and changes[-1] != "*" and b != "*" \
@@ -437,15 +1348,93 @@ def simplify_changes(boxes):
         changes.append(b)
     return changes
 
+def simplify_change_refs(boxes, docs):
+    # simplify_changes for (pdf index, row) references into the BoxStores
+    # in docs. Returns (pdf index, first row, last row) runs, which can be
+    # turned into the same dicts as simplify_changes with expand_changes.
+    changes = []
+    for b in boxes:
+        if len(changes) > 0 and changes[-1] != "*" and b != "*" \
+            and changes[-1][0] == b[0]:
+            pdf, first, last = changes[-1]
+            doc = docs[pdf]
+            row = b[1]
+            if doc.page[first] == doc.page[row] \
+                and doc.index[last]+1 == doc.index[row] \
+                and doc.y[first] == doc.y[row] \
+                and doc.height[first] == doc.height[row]:
+                changes[-1] = (pdf, first, row)
+                continue
+        changes.append(b if b == "*" else (b[0], b[1], b[1]))
+    return changes
+
 # Rasterizes a page of a PDF.
 def pdftopng(pdffile, pagenumber,width):
-    pngbytes = subprocess.check_output(["pdftoppm", "-f", str(pagenumber), "-l", str(pagenumber), "-scale-to", str(width), "-png", pdffile])
+    with tempfile.TemporaryDirectory(prefix="pdf-diff-") as tmpdir:
+        pngs = pdftopngs(pdffile, pagenumber, pagenumber, width, os.path.join(tmpdir, "page"))
+    return png_to_image(pngs[pagenumber])
+
+# The ink level of each gray level (the darkest black becomes almost
+# black to free the last index), and the palette of ink images.
+INK_LEVELS = [min(255 - level, 254) for level in range(256)]
+INK_PALETTE = [255 - level for level in range(255) for channel in range(3)] + [255, 0, 0]
+
+def png_to_image(pngbytes, ink=False):
+    # Load a page raster. With ink, the raster is grayscale and is loaded
+    # as an "ink image" using one byte per pixel: a palette image whose
+    # indexes are the amount of ink, so that blank paper is zero, with the
+    # last index reserved for drawing the changes in red.
     im = Image.open(io.BytesIO(pngbytes))
-    return im.convert("RGBA")
+    if not ink:
+        return im.convert("RGBA")
+    im = im.convert("L").point(INK_LEVELS)
+    im.putpalette(INK_PALETTE)
+    return im
+
+# Rasterizes a range of pages of a PDF with one run of pdftoppm. The
+# images are written to files starting with prefix and returned as PNG
+# bytes by page number. crop is an optional (x, y, width, height) area
+# of each page to rasterize, in pixels. With gray, the images are
+# grayscale.
+def pdftopngs(pdffile, first_page, last_page, width, prefix, crop=None, gray=False):
+    options = []
+    if crop is not None:
+        options += ["-x", str(crop[0]), "-y", str(crop[1]), "-W", str(crop[2]), "-H", str(crop[3])]
+    if gray:
+        options.append("-gray")
+    start = time.perf_counter()
+    subprocess.check_call(["pdftoppm", "-f", str(first_page), "-l", str(last_page), "-scale-to", str(width)] + options + ["-png", pdffile, prefix])
+    profiling.subprocess_time("pdftoppm", time.perf_counter() - start)
+    pngs = {}
+    directory, name = os.path.split(prefix)
+    for fn in os.listdir(directory):
+        # pdftoppm zero-pads the page numbers.
+        m = re.match(re.escape(name) + r"-(\d+)\.png$", fn)
+        if m:
+            with open(os.path.join(directory, fn), "rb") as f:
+                pngs[int(m.group(1))] = f.read()
+            os.unlink(os.path.join(directory, fn))
+    return pngs
 
 def main():
     import argparse
 
+    if sys.argv[1:2] == ['batch']:
+        # pdf-diff batch manifest.json ...
+        from pdf_diff.batch import main as batch_main
+        batch_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['series']:
+        # pdf-diff series v1.pdf v2.pdf v3.pdf ...
+        from pdf_diff.series import main as series_main
+        series_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['serve']:
+        # pdf-diff serve ...
+        from pdf_diff.server import main as server_main
+        server_main(sys.argv[2:])
+        return
+
     description = ('Calculates the differences between two specified files in PDF format '
                    '(or changes specified on standard input) and outputs to standard output '
                    'side-by-side images with the differences marked (in PNG format).')
@@ -457,20 +1446,54 @@ def main():
     parser.add_argument('-s', '--style', metavar='box|strike|underline,box|stroke|underline', 
                         default='strike,underline',
                         help='how to mark the differences in the two files (default: strike, underline)')
-    parser.add_argument('-f', '--format', choices=['png','gif','jpeg','ppm','tiff'], default='png',
+    parser.add_argument('-f', '--format', choices=['png','gif','jpeg','ppm','tiff','pdf'], default='png',
                         help='output format in which to render (default: png)')
+    parser.add_argument('-o', '--output', metavar='file',
+                        help='write the output to this file instead of standard output')
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='only check whether the text of the two files is the same, stopping at the first difference, and exit with status 0 if it is, 1 if not, or 2 if there was an error such as an unreadable file')
+    parser.add_argument('--annotate', nargs=2, metavar=('out1.pdf', 'out2.pdf'),
+                        help='instead of rendering an image, write copies of the two files to these file names with the differences marked as PDF annotations (requires pypdf)')
+    parser.add_argument('--paginate', action='store_true', default=False,
+                        help='output one image for each group of pages that line up instead of one large image, writing each as it is finished: as the pages of one file with the tiff and pdf formats, or else to files named by --output with %%d replaced by the image number')
     parser.add_argument('-t', '--top-margin', metavar='margin', default=0., type=float,
                         help='top margin (ignored area) end in percent of page height (default 0.0)')
     parser.add_argument('-b', '--bottom-margin', metavar='margin', default=100., type=float,
                         help='bottom margin (ignored area) begin in percent of page height (default 100.0)')
     parser.add_argument('-r', '--result-width', default=900, type=int,
                         help='width of the result image (width of image in px)')
+    parser.add_argument('-e', '--diff-engine', choices=['char', 'word'], default='char',
+                        help='compare the text character by character, or word by word which is faster on long documents (default: char)')
+    parser.add_argument('-p', '--page-anchors', action='store_true', default=False,
+                        help='only compare the text between pages that are identical in the two files (faster when few pages changed)')
+    parser.add_argument('--time-budget', metavar='seconds', type=float,
+                        help='compare the text in segments between words that occur once in each file, and mark any segment that takes longer than this to compare as entirely changed')
+    parser.add_argument('--size-budget', metavar='chars', type=int,
+                        help='like --time-budget, but mark segments with more than this many characters as entirely changed')
+    parser.add_argument('--region-only', action='store_true', default=False,
+                        help='only rasterize the part of each page around its changes')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='rasterize pages in grayscale, using a quarter of the memory for page images, and output an RGB rather than RGBA image')
+    parser.add_argument('-j', '--workers', metavar='N', default=1, type=int,
+                        help='extract and rasterize the two files at once, split into page ranges across N workers (default 1)')
+    parser.add_argument('--cache', action='store_true', default=False,
+                        help='reuse text extracted from and pages rasterized from the same PDFs in earlier runs (enabled by default if PDF_DIFF_CACHE_DIR is set)')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='do not use the cache')
+    parser.add_argument('--cache-dir', metavar='dir',
+                        help='cache directory, implies --cache (default $PDF_DIFF_CACHE_DIR or ~/.cache/pdf-diff)')
+    parser.add_argument('--cache-size', metavar='MB', default=DEFAULT_MAX_SIZE//(1024*1024), type=int,
+                        help='evict least recently used cache entries beyond this size (default %d)' % (DEFAULT_MAX_SIZE//(1024*1024)))
+    parser.add_argument('--clear-cache', action='store_true', default=False,
+                        help='empty the cache first')
+    parser.add_argument('--profile', metavar='file',
+                        help='measure the time and memory used by each stage and write them as JSON to this file, or to standard error if it is -')
     args = parser.parse_args()
 
     def invalid_usage(msg):
         sys.stderr.write('ERROR: %s%s' % (msg, os.linesep))
         parser.print_usage(sys.stderr)
-        sys.exit(1)
+        sys.exit(2 if args.check else 1) # in check mode, 1 means the files differ
 
     # Validate style
     style = args.style.split(',')
@@ -480,24 +1503,103 @@ def main():
         if style[i] != 'box' and style[i] != 'strike' and style[i] != 'underline':
             invalid_usage('--style values must be box, strike or underline, not "%s".' % (style[i]))
 
+    if args.workers < 1:
+        invalid_usage('--workers must be at least 1.')
+
+    if args.paginate and args.format != 'pdf':
+        if not args.output:
+            invalid_usage('--paginate requires --output, except with the pdf format.')
+        if args.format != 'tiff' and '%d' not in args.output:
+            invalid_usage('With --paginate and the %s format, --output must contain %%d for the image number.' % args.format)
+
+    if (args.time_budget is not None and args.time_budget <= 0) or (args.size_budget is not None and args.size_budget <= 0):
+        invalid_usage('--time-budget and --size-budget must be positive.')
+
+    cache = None
+    if (args.cache or args.cache_dir or os.environ.get("PDF_DIFF_CACHE_DIR")) and not args.no_cache:
+        cache = DiskCache(args.cache_dir, args.cache_size*1024*1024)
+    if args.clear_cache:
+        DiskCache(args.cache_dir).clear()
+        if len(args.files) == 0 and not args.changes:
+            sys.exit(0)
+
     # Ensure one of files or --changes are specified
     if len(args.files) == 0 and not args.changes:
         invalid_usage('Please specify files to compare, or use --changes option.')
 
-    if args.changes:
-        # to just do the rendering part
-        img = render_changes(json.load(sys.stdin), style, args.result_width)
-        img.save(sys.stdout.buffer, args.format.upper())
-        sys.exit(0)
+    if args.check and args.changes:
+        invalid_usage('--check compares files and cannot be used with --changes.')
 
     # Ensure enough file are specified
-    if len(args.files) != 2:
+    if not args.changes and len(args.files) != 2:
         invalid_usage('Insufficient number of files to compare; please supply exactly 2.')
 
-    changes = compute_changes(args.files[0], args.files[1], top_margin=float(args.top_margin), bottom_margin=float(args.bottom_margin))
-    img = render_changes(changes, style, args.result_width)
-    img.save(sys.stdout.buffer, args.format.upper())
+    if args.profile is not None:
+        if args.profile != '-' and os.path.realpath(args.profile) in [os.path.realpath(fn) for fn in args.files]:
+            invalid_usage('--profile must not be one of the files to compare.')
+
+        # Report the measurements when the run ends, however it ends.
+        atexit.register(write_profile, profiling.Profiler().start(), args.profile)
+
+    def write_output(changes):
+        if args.annotate:
+            with profiling.stage("annotate"):
+                annotate_changes(changes, style, args.annotate, args.files if len(args.files) == 2 else None)
+            return
+        if args.paginate:
+            images = render_change_groups(changes, style, args.result_width, args.workers, cache, args.region_only, args.low_memory)
+        else:
+            images = [render_changes(changes, style, args.result_width, args.workers, cache, args.region_only, args.low_memory)]
+        if args.paginate or args.format == 'pdf':
+            save_change_groups(images, args.output or sys.stdout.buffer, args.format)
+        else:
+            images[0].save(args.output or sys.stdout.buffer, args.format.upper())
+
+    if args.changes:
+        # to just do the rendering part
+        write_output(json.load(sys.stdin))
+        sys.exit(0)
+
+    if args.check:
+        try:
+            with profiling.stage("check"):
+                difference = check_identical(args.files[0], args.files[1], top_margin=float(args.top_margin), bottom_margin=float(args.bottom_margin))
+        except Exception as e:
+            # Exit with 2 as cmp and diff do, so that an error isn't taken
+            # for a difference.
+            sys.stderr.write('ERROR: %s%s' % (e, os.linesep))
+            sys.exit(2)
+        if difference is None:
+            print('The files have the same text.')
+            sys.exit(0)
+        print('The files differ starting at %s.' % ' and '.join(
+            ('page %d of %s' % (pdf["page"], pdf["file"])) if pdf["page"] is not None else ('the end of %s' % pdf["file"])
+            for pdf in difference["pdfs"]))
+        sys.exit(1)
 
+    budget = None
+    if args.time_budget is not None or args.size_budget is not None:
+        budget = DiffBudget(args.time_budget, args.size_budget)
+
+    changes, docs = compute_change_refs(args.files[0], args.files[1], top_margin=float(args.top_margin), bottom_margin=float(args.bottom_margin), workers=args.workers, cache=cache, engine=args.diff_engine, page_anchors=args.page_anchors, budget=budget)
+    if budget is not None:
+        for segment in budget.degraded:
+            sys.stderr.write('WARNING: Text on pages %d-%d of %s and pages %d-%d of %s exceeded the %s budget and is marked as entirely changed.%s' % (
+                segment["pdfs"][0]["pages"][0], segment["pdfs"][0]["pages"][1], segment["pdfs"][0]["file"],
+                segment["pdfs"][1]["pages"][0], segment["pdfs"][1]["pages"][1], segment["pdfs"][1]["file"],
+                segment["reason"], os.linesep))
+    changes = expand_changes(simplify_changes(changes, docs), docs)
+    del docs
+    write_output(changes)
+
+def write_profile(profiler, fn):
+    profiler.stop()
+    report = json.dumps(profiler.report(), indent=2)
+    if fn == "-":
+        sys.stderr.write(report + os.linesep)
+    else:
+        with open(fn, "w") as f:
+            f.write(report + "\n")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,71 @@
+# Write images as the pages of a PDF, one page at a time.
+#
+# Pillow can write a multi-page PDF only from a list of all of the images
+# at once, or by re-reading and rewriting the page tree of the file for
+# each page that is appended. PdfImageWriter writes each page as it is
+# given and the page tree at the end, so only one image needs to be in
+# memory at a time, and the file doesn't need to be seekable (it can be
+# standard output).
+
+import zlib
+
+class PdfImageWriter:
+    def __init__(self, f, resolution=72.0):
+        self.f = f
+        self.resolution = resolution # pixels per inch
+        self.position = 0
+        self.offsets = { } # object number => where it starts in the file
+        self.pages = [] # object numbers of the pages
+        self.next_object = 3 # 1 and 2 are the catalog and the page tree
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+
+    def write(self, data):
+        self.f.write(data)
+        self.position += len(data)
+
+    def write_object(self, number, dictionary, stream=None):
+        self.offsets[number] = self.position
+        self.write(b"%d 0 obj\n" % number + dictionary)
+        if stream is not None:
+            self.write(b"\nstream\n")
+            self.write(stream)
+            self.write(b"\nendstream")
+        self.write(b"\nendobj\n")
+
+    def add_page(self, im):
+        # Add a page showing the image, losslessly compressed.
+        im = im.convert("RGB")
+        image, contents, page = range(self.next_object, self.next_object+3)
+        self.next_object += 3
+
+        data = zlib.compress(im.tobytes())
+        self.write_object(image, b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /FlateDecode /Length %d >>"
+            % (im.size[0], im.size[1], len(data)), data)
+
+        width = im.size[0] * 72.0 / self.resolution
+        height = im.size[1] * 72.0 / self.resolution
+        data = b"q %f 0 0 %f 0 0 cm /image Do Q" % (width, height)
+        self.write_object(contents, b"<< /Length %d >>" % len(data), data)
+
+        self.write_object(page, b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %f %f] /Resources << /XObject << /image %d 0 R >> >> /Contents %d 0 R >>"
+            % (width, height, image, contents))
+        self.pages.append(page)
+
+    def close(self):
+        # Write the page tree, the catalog, and the cross-reference table.
+        self.write_object(2, b"<< /Type /Pages /Count %d /Kids [%s] >>"
+            % (len(self.pages), b" ".join(b"%d 0 R" % page for page in self.pages)))
+        self.write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref = self.position
+        self.write(b"xref\n0 %d\n" % self.next_object)
+        self.write(b"0000000000 65535 f \n")
+        for number in range(1, self.next_object):
+            self.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (self.next_object, xref))
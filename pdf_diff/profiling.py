@@ -0,0 +1,143 @@
+# Per-stage measurements of a run of pdf-diff.
+#
+# The stages of the pipeline are wrapped in "with stage(name):" blocks,
+# and the programs it runs and the sizes of its intermediate results are
+# reported with subprocess_time and count. These do nothing unless a
+# Profiler is active:
+#
+#   with Profiler() as profiler:
+#       compute_changes(...)
+#   json.dumps(profiler.report())
+#
+# For each stage, the report has the number of times it ran, its wall
+# and CPU time (of the thread that ran it, so stages run in parallel are
+# each measured on their own), and the peak resident memory of the
+# process when it ended and how much the stage raised it. It also has
+# the number and wall time of the runs of each program (pdftotext, ...),
+# the counts, and totals for the run. The overhead is a few microseconds
+# per stage, and there are only a few stages per page.
+
+import sys, threading, time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# The Profiler that measurements are reported to, if any.
+active = None
+
+def peak_rss():
+    # The peak resident memory of this process so far, in bytes.
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024 # kilobytes, except on macOS
+
+def children_cpu_time():
+    # The CPU time of the programs this process ran and waited for.
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = { }
+        self.subprocesses = { }
+        self.counts = { }
+
+    def start(self):
+        # Make this the active Profiler.
+        global active
+        self.previous = active
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_children_cpu = children_cpu_time()
+        active = self
+        return self
+
+    def stop(self):
+        # Stop measuring, and make the previously active Profiler active
+        # again.
+        global active
+        active = self.previous
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+        self.children_cpu = children_cpu_time()
+        if self.children_cpu is not None:
+            self.children_cpu -= self.start_children_cpu
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_stage(self, name, wall, cpu, rss, rss_growth):
+        with self.lock:
+            entry = self.stages.setdefault(name, { "calls": 0, "wall": 0.0, "cpu": 0.0, "peak_rss": None, "rss_growth": 0 })
+            entry["calls"] += 1
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            if rss is not None:
+                entry["peak_rss"] = max(entry["peak_rss"] or 0, rss)
+                entry["rss_growth"] += rss_growth
+
+    def add_subprocess(self, program, wall):
+        with self.lock:
+            entry = self.subprocesses.setdefault(program, { "runs": 0, "wall": 0.0 })
+            entry["runs"] += 1
+            entry["wall"] += wall
+
+    def add_count(self, name, n):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self):
+        # The measurements as a JSON-serializable dict. Times are in
+        # seconds and memory in bytes.
+        with self.lock:
+            report = {
+                "stages": { name: dict(entry) for name, entry in self.stages.items() },
+                "subprocesses": { name: dict(entry) for name, entry in self.subprocesses.items() },
+                "counts": dict(self.counts),
+            }
+        if hasattr(self, "wall"):
+            report["total"] = {
+                "wall": self.wall,
+                "cpu": self.cpu,
+                "subprocess_cpu": self.children_cpu,
+                "peak_rss": peak_rss(),
+            }
+        return report
+
+@contextmanager
+def stage(name):
+    # Measure a stage of the pipeline.
+    profiler = active
+    if profiler is None:
+        yield
+        return
+    rss = peak_rss()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.thread_time() - cpu
+        end_rss = peak_rss()
+        profiler.add_stage(name, wall, cpu, end_rss, end_rss - rss if rss is not None else None)
+
+def subprocess_time(program, wall):
+    # Report a run of a program that took wall seconds.
+    if active is not None:
+        active.add_subprocess(program, wall)
+
+def count(name, n):
+    # Add n to a count, e.g. of words or changes.
+    if active is not None:
+        active.add_count(name, n)
@@ -0,0 +1,251 @@
+# Compare a series of revisions of a PDF.
+#
+# Comparing each revision with the next (v1 => v2 => ... => vN), or each
+# with the first, by calling compute_changes on each pair would extract
+# most versions more than once. Here each version is extracted once and
+# kept serialized (see BoxStore.to_bytes), the pairs are diffed in
+# parallel in worker processes, and a version is dropped as soon as no
+# pair still to be diffed needs it, so only the versions of the pairs in
+# progress are in memory.
+# The changes are then rendered pair by pair, and the pages of a version
+# rasterized for one pair are reused by the later pairs that show them
+# and dropped once no pair still to be rendered needs them.
+
+import json, multiprocessing, os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from pdf_diff.boxes import BoxStore
+from pdf_diff.cache import DiskCache, file_digest
+from pdf_diff.command_line import DiffBudget, diff_docs, expand_changes, raster_cache_key, render_changes, save_change_groups, serialize_pdf, simplify_changes
+
+SERIES_MODES = ("chain", "first")
+
+def series_pairs(count, mode="chain"):
+    # The (before, after) indexes of the versions compared: each version
+    # with the next ("chain") or each version with the first ("first").
+    if mode == "chain":
+        return [(i, i+1) for i in range(count-1)]
+    if mode == "first":
+        return [(0, i) for i in range(1, count)]
+    raise ValueError(mode)
+
+def compute_series(files, mode="chain", top_margin=0, bottom_margin=100, workers=1, cache=None, engine="char", page_anchors=False, budget=None):
+    # Compute the changes of each pair of series_pairs(len(files), mode)
+    # and return them in a list in the same order. The changes are as
+    # returned by compute_changes, but with sequential boxes merged as
+    # simplify_changes does. Up to workers pairs are diffed at once, in
+    # worker processes (the diff holds the GIL, so threads wouldn't run
+    # them in parallel), and the versions they need are extracted at the
+    # same time. If a DiskCache is given, previously extracted versions are
+    # loaded from it. If a DiffBudget is given, the segments of all of the
+    # pairs that exceeded it are collected in its degraded list.
+    pairs = series_pairs(len(files), mode)
+    results = [None] * len(pairs)
+
+    # The number of pairs not diffed yet that need each version.
+    remaining = [0] * len(files)
+    for pair in pairs:
+        for version in pair:
+            remaining[version] += 1
+
+    def extract(version):
+        return serialize_pdf(0, files[version], top_margin, bottom_margin, cache=cache).to_bytes()
+
+    with ThreadPoolExecutor(workers) as extract_executor, \
+         (process_pool(workers) if workers > 1 else ThreadPoolExecutor(1)) as diff_executor:
+        stores = { } # version => future serialized BoxStore
+        waiting = deque(enumerate(pairs)) # pairs not started
+        extracting = [] # pairs whose versions are being extracted
+        running = { } # future changes => pair index
+        while waiting or extracting or running:
+            # Start extracting the versions of more pairs.
+            while waiting and len(extracting) + len(running) < workers:
+                i, pair = waiting.popleft()
+                for version in pair:
+                    if version not in stores:
+                        stores[version] = extract_executor.submit(extract, version)
+                extracting.append((i, pair))
+
+            # Diff the pairs whose versions are extracted.
+            for i, pair in list(extracting):
+                if all(stores[version].done() for version in pair):
+                    extracting.remove((i, pair))
+                    future = diff_executor.submit(diff_pair, [stores[version].result() for version in pair],
+                        [files[version] for version in pair], engine, page_anchors, budget)
+                    running[future] = i
+
+            done, not_done = wait(list(running) + [stores[version] for i, pair in extracting for version in pair if not stores[version].done()],
+                                  return_when=FIRST_COMPLETED)
+            for future in done:
+                if future not in running:
+                    continue # an extraction
+                i = running.pop(future)
+                results[i], degraded = future.result()
+                if budget is not None:
+                    budget.degraded.extend(degraded)
+                for version in pairs[i]:
+                    remaining[version] -= 1
+                    if remaining[version] == 0:
+                        del stores[version]
+    return results
+
+def process_pool(workers):
+    # Start the worker processes from a fork server rather than by forking
+    # this process, whose other threads may have the pipe of a pdftotext
+    # open that the workers would then hold open too.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["pdf_diff.series"])
+        return ProcessPoolExecutor(workers, mp_context=context)
+    return ProcessPoolExecutor(workers)
+
+def diff_pair(data, files, engine, page_anchors, budget):
+    # Run in a worker: diff two serialized BoxStores and return the
+    # expanded changes and the segments that exceeded the budget.
+    docs = [BoxStore.from_bytes(data[idx], idx, files[idx]) for idx in (0, 1)]
+    if budget is not None:
+        budget = DiffBudget(budget.time, budget.size)
+    changes = diff_docs(docs, engine, page_anchors, budget)
+    return expand_changes(simplify_changes(changes, docs), docs), (budget.degraded if budget is not None else [])
+
+def render_series(files, series_changes, styles, width, mode="chain", workers=1, cache=None, region_only=False, low_memory=False):
+    # Render the changes of each pair from compute_series as
+    # render_changes does, yielding an image for each pair in order, or
+    # None for a pair with no changes. Page rasters are shared between
+    # the pairs (except with region_only, where each pair rasterizes only
+    # the parts of the pages it needs) and are also looked up in and saved
+    # to a DiskCache, if given.
+    pairs = series_pairs(len(files), mode)
+    rasters = RasterMemo(cache)
+    raster_keys = [set() for fn in files] # the rasters of each version that were used
+    digests = { }
+
+    # The number of pairs not rendered yet that need each version.
+    remaining = [0] * len(files)
+    for pair, changes in zip(pairs, series_changes):
+        for version in pair:
+            remaining[version] += 1
+
+    for pair, changes in zip(pairs, series_changes):
+        if any(change != "*" for change in changes):
+            # Note the rasters this pair uses before render_changes
+            # rewrites the changes' pages.
+            for change in changes:
+                if change == "*": continue
+                version = pair[change["pdf"]["index"]]
+                if version not in digests:
+                    digests[version] = file_digest(files[version])
+                raster_keys[version].add(raster_cache_key(digests[version], change["page"]["number"], width, low_memory))
+            img = render_changes(changes, styles, width, workers, rasters, region_only, low_memory)
+        else:
+            img = None
+
+        for version in pair:
+            remaining[version] -= 1
+            if remaining[version] == 0:
+                rasters.forget("rasters", raster_keys[version])
+                raster_keys[version] = None
+        yield img
+
+class RasterMemo:
+    # Keeps the entries read from or saved to a cache in memory, in front
+    # of a DiskCache if one is given, until they are forgotten. It has the
+    # get and put methods of a DiskCache so that it can be passed in
+    # place of one.
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.entries = { }
+
+    def get(self, namespace, key):
+        data = self.entries.get((namespace, key))
+        if data is None and self.cache is not None:
+            data = self.cache.get(namespace, key)
+            if data is not None:
+                self.entries[(namespace, key)] = data
+        return data
+
+    def put(self, namespace, key, data):
+        self.entries[(namespace, key)] = data
+        if self.cache is not None:
+            self.cache.put(namespace, key, data)
+
+    def forget(self, namespace, keys):
+        for key in keys:
+            self.entries.pop((namespace, key), None)
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pdf-diff series',
+        description='Compares a series of revisions of a PDF, each with the next or each with the first, '
+                    'extracting each revision only once, and writes the changes (as JSON) and an image for '
+                    'each pair to an output directory.')
+    parser.add_argument('files', nargs='+',
+                        help='the revisions, in order')
+    parser.add_argument('-o', '--output-dir', metavar='dir', required=True,
+                        help='directory to write the output files to, named by the numbers of the revisions compared, e.g. 1-2.json and 1-2.png')
+    parser.add_argument('--first', action='store_true', default=False,
+                        help='compare each revision with the first rather than with the one before it')
+    parser.add_argument('-s', '--style', metavar='box|strike|underline,box|stroke|underline',
+                        default='strike,underline',
+                        help='how to mark the differences in the two files (default: strike, underline)')
+    parser.add_argument('-f', '--format', choices=['png','gif','jpeg','ppm','tiff','pdf'], default='png',
+                        help='output format in which to render (default: png)')
+    parser.add_argument('-t', '--top-margin', metavar='margin', default=0., type=float,
+                        help='top margin (ignored area) end in percent of page height (default 0.0)')
+    parser.add_argument('-b', '--bottom-margin', metavar='margin', default=100., type=float,
+                        help='bottom margin (ignored area) begin in percent of page height (default 100.0)')
+    parser.add_argument('-r', '--result-width', default=900, type=int,
+                        help='width of the result image (width of image in px)')
+    parser.add_argument('-e', '--diff-engine', choices=['char', 'word'], default='char',
+                        help='compare the text character by character, or word by word which is faster on long documents (default: char)')
+    parser.add_argument('-p', '--page-anchors', action='store_true', default=False,
+                        help='only compare the text between pages that are identical in the two files (faster when few pages changed)')
+    parser.add_argument('--region-only', action='store_true', default=False,
+                        help='only rasterize the part of each page around its changes')
+    parser.add_argument('--low-memory', action='store_true', default=False,
+                        help='rasterize pages in grayscale and output RGB rather than RGBA images')
+    parser.add_argument('--no-render', action='store_true', default=False,
+                        help='only write the changes, and not the images')
+    parser.add_argument('-j', '--workers', metavar='N', default=1, type=int,
+                        help='number of pairs to compare at once, in worker processes, and of workers to rasterize pages with (default 1)')
+    parser.add_argument('--cache-dir', metavar='dir',
+                        help='also reuse text extracted from and pages rasterized from the same PDFs in this cache directory in earlier runs')
+    args = parser.parse_args(argv)
+
+    style = args.style.split(',')
+    if len(style) != 2 or any(s not in ('box', 'strike', 'underline') for s in style):
+        parser.error('--style must be two of box, strike or underline, separated by a comma.')
+    if len(args.files) < 2:
+        parser.error('Please supply at least two revisions to compare.')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1.')
+
+    mode = "first" if args.first else "chain"
+    cache = DiskCache(args.cache_dir) if args.cache_dir else None
+    series_changes = compute_series(args.files, mode, top_margin=args.top_margin, bottom_margin=args.bottom_margin,
+        workers=args.workers, cache=cache, engine=args.diff_engine, page_anchors=args.page_anchors)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    names = ["%d-%d" % (before+1, after+1) for before, after in series_pairs(len(args.files), mode)]
+    for name, changes in zip(names, series_changes):
+        with open(os.path.join(args.output_dir, name + ".json"), "w") as f:
+            json.dump(changes, f)
+    counts = [sum(1 for change in changes if change != "*") for changes in series_changes]
+
+    if not args.no_render:
+        images = render_series(args.files, series_changes, style, args.result_width, mode,
+            args.workers, cache, args.region_only, args.low_memory)
+        for name, img in zip(names, images):
+            if img is None:
+                continue
+            fn = os.path.join(args.output_dir, name + "." + args.format)
+            if args.format == "pdf":
+                save_change_groups([img], fn, "pdf")
+            else:
+                img.save(fn, args.format.upper())
+
+    for (before, after), count in zip(series_pairs(len(args.files), mode), counts):
+        print('%s => %s: %s' % (args.files[before], args.files[after],
+            ('%d changes' % count) if count > 0 else 'no text differences'))
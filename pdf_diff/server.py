@@ -0,0 +1,402 @@
+# A resident server for comparing PDFs.
+#
+# Running pdf-diff once per comparison pays for starting Python and
+# importing lxml and PIL every time. The server is started once and
+# answers requests over HTTP, on a localhost port or a Unix socket:
+#
+#   POST /compute   {"before": file, "after": file, ...options}
+#                   => the changes, as returned by compute_changes
+#   POST /render    {"before": file, "after": file, ...options}
+#                   or {"changes": [...], ...options}
+#                   => the image (204 No Content if there are no changes)
+#   DELETE /requests/<id>
+#                   cancels the request with that id, given by the client
+#                   in an X-Request-Id header
+#   GET /status     => the number of running and queued requests
+#
+# The options are those of a pair in a batch (see pdf_diff.batch).
+#
+# Each request runs in its own process, started from a process that has
+# already imported pdf-diff, so that a request can be cancelled even
+# while it is running by killing it (along with any pdftotext or
+# pdftoppm it started). Only so many requests run at once and only so
+# many more may wait; beyond that, requests are refused with 503.
+# Extracted text and rasterized pages are kept in a DiskCache shared by
+# all requests, so files that were seen before are not processed again.
+# The requests write to it without a size limit, and the server keeps
+# track of how much they wrote and evicts entries when it is full, so
+# that each request's process doesn't list the whole cache to find out
+# its size.
+
+import http.server, io, json, multiprocessing, os, signal, socketserver, stat, sys, threading
+from collections import deque
+
+from pdf_diff.batch import DEFAULT_OPTIONS
+from pdf_diff.cache import DiskCache
+from pdf_diff.command_line import compute_changes, compute_change_refs, expand_changes, render_changes, save_change_groups, simplify_changes
+
+DEFAULT_PORT = 8470
+
+CONTENT_TYPES = {
+    "png": "image/png",
+    "gif": "image/gif",
+    "jpeg": "image/jpeg",
+    "ppm": "image/x-portable-pixmap",
+    "tiff": "image/tiff",
+    "pdf": "application/pdf",
+}
+
+class QueueFull(Exception):
+    pass
+
+class Cancelled(Exception):
+    pass
+
+class DiffService:
+    # Runs requests in worker processes, at most workers at a time and
+    # with at most queue_size more waiting, in the order they arrive.
+    def __init__(self, workers=2, queue_size=16, cache=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.cache = cache
+        self.request_cache = DiskCache(cache.path, max_size=None) if cache is not None else None
+        self.cache_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = deque()
+        self.requests = { } # id => Request, for cancellation
+
+        # Start request processes from a server process that has imported
+        # pdf-diff already. (Forking the threaded HTTP server itself is
+        # not safe.)
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("forkserver")
+            self.context.set_forkserver_preload(["pdf_diff.server"])
+        else:
+            self.context = multiprocessing.get_context()
+
+    def status(self):
+        with self.condition:
+            return {
+                "running": self.running,
+                "queued": len(self.waiting),
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+            }
+
+    def run(self, kind, params, request_id=None):
+        # Run a request and return (HTTP status, content type, body).
+        # Raises QueueFull if there is no room for it and Cancelled if it
+        # is cancelled.
+        request = Request(kind, params)
+        with self.condition:
+            if self.running + len(self.waiting) >= self.workers + self.queue_size:
+                raise QueueFull()
+            if request_id is not None:
+                if request_id in self.requests:
+                    raise ValueError("There is already a request with id %s." % request_id)
+                self.requests[request_id] = request
+            self.waiting.append(request)
+
+        running = False
+        try:
+            with self.condition:
+                # Wait for a worker.
+                while (self.running >= self.workers or self.waiting[0] is not request) and not request.cancelled:
+                    self.condition.wait()
+                self.waiting.remove(request)
+                if not request.cancelled:
+                    self.running += 1
+                    running = True
+                    request.start(self.context, self.request_cache)
+                self.condition.notify_all()
+
+            if request.cancelled:
+                raise Cancelled()
+            result, bytes_written = request.result()
+            if self.cache is not None and bytes_written > 0:
+                with self.cache_lock:
+                    self.cache.added(bytes_written)
+            return result
+        finally:
+            # Release the worker and the id, also if the request's process
+            # couldn't be started.
+            with self.condition:
+                if running:
+                    self.running -= 1
+                if request_id is not None:
+                    del self.requests[request_id]
+                self.condition.notify_all()
+
+    def cancel(self, request_id):
+        # Cancel a waiting or running request. Returns False if there is no
+        # request with the id.
+        with self.condition:
+            request = self.requests.get(request_id)
+            if request is None:
+                return False
+            request.cancel()
+            self.condition.notify_all()
+            return True
+
+class Request:
+    def __init__(self, kind, params):
+        self.kind = kind
+        self.params = params
+        self.process = None
+        self.connection = None
+        self.cancelled = False
+
+    def start(self, context, cache):
+        self.connection, child_connection = context.Pipe(duplex=False)
+        try:
+            self.process = context.Process(target=run_request, args=(child_connection, self.kind, self.params, cache), daemon=True)
+            self.process.start()
+        except:
+            self.connection.close()
+            raise
+        finally:
+            child_connection.close()
+
+    def result(self):
+        # Returns the response and the number of bytes the request wrote
+        # to the cache.
+        try:
+            result, bytes_written = self.connection.recv()
+        except EOFError:
+            # The process ended without sending a result. Whatever it
+            # wrote to the cache is counted the next time it is listed.
+            result, bytes_written = None, 0
+        self.process.join()
+        self.connection.close()
+        if self.cancelled:
+            raise Cancelled()
+        if result is None:
+            result = (500, "application/json", json.dumps({ "error": "The request's process exited with status %s." % self.process.exitcode }).encode("utf8"))
+        return result, bytes_written
+
+    def cancel(self):
+        self.cancelled = True
+        if self.process is not None and self.process.pid is not None and self.process.exitcode is None:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (AttributeError, ProcessLookupError):
+                # No process groups on this platform, or the process hasn't
+                # made its group yet (or has just finished).
+                self.process.kill()
+
+def run_request(connection, kind, params, cache):
+    # Run in a request's process: compute the response and send it back.
+    if hasattr(os, "setpgrp"):
+        # Put the process and the programs it runs in their own process
+        # group, so that cancelling the request can kill them all.
+        os.setpgrp()
+    try:
+        result = REQUEST_KINDS[kind](params, cache)
+    except Exception as e:
+        result = (500, "application/json", json.dumps({ "error": "%s: %s" % (type(e).__name__, e) }).encode("utf8"))
+    connection.send((result, cache.bytes_written if cache is not None else 0))
+    connection.close()
+
+def compute_request(params, cache):
+    changes = compute_changes(params["before"], params["after"],
+        top_margin=params["top_margin"], bottom_margin=params["bottom_margin"],
+        cache=cache, engine=params["diff_engine"], page_anchors=params["page_anchors"])
+    return (200, "application/json", json.dumps(changes).encode("utf8"))
+
+def render_request(params, cache):
+    if "changes" in params:
+        changes = params["changes"]
+    else:
+        changes, docs = compute_change_refs(params["before"], params["after"],
+            top_margin=params["top_margin"], bottom_margin=params["bottom_margin"],
+            cache=cache, engine=params["diff_engine"], page_anchors=params["page_anchors"])
+        changes = expand_changes(simplify_changes(changes, docs), docs)
+        del docs
+    if all(change == "*" for change in changes):
+        return (204, None, b"")
+
+    img = render_changes(changes, params["style"].split(","), params["width"],
+        cache=cache, region_only=params["region_only"], low_memory=params["low_memory"])
+    buf = io.BytesIO()
+    if params["format"] == "pdf":
+        save_change_groups([img], buf, "pdf")
+    else:
+        img.save(buf, params["format"].upper())
+    return (200, CONTENT_TYPES[params["format"]], buf.getvalue())
+
+REQUEST_KINDS = {
+    "compute": compute_request,
+    "render": render_request,
+}
+
+def request_params(kind, body):
+    # Validate a request body and fill in the default options.
+    if not isinstance(body, dict):
+        raise ValueError("The request body must be a JSON object.")
+    params = dict(DEFAULT_OPTIONS)
+    for key, value in body.items():
+        if key not in DEFAULT_OPTIONS and key not in ("before", "after", "changes"):
+            raise ValueError("Unknown option: %s." % key)
+        params[key] = value
+    if kind == "render" and "changes" in params:
+        if not isinstance(params["changes"], list):
+            raise ValueError("changes must be a list.")
+    elif not isinstance(params.get("before"), str) or not isinstance(params.get("after"), str):
+        raise ValueError("before and after must be file names.")
+
+    # Check the types of the options here, so that bad ones are reported
+    # as such and not as an error of the request's process.
+    try:
+        params["top_margin"] = float(params["top_margin"])
+        params["bottom_margin"] = float(params["bottom_margin"])
+        params["width"] = int(params["width"])
+    except (TypeError, ValueError):
+        raise ValueError("top_margin and bottom_margin must be numbers and width an integer.")
+    if params["width"] < 1:
+        raise ValueError("width must be at least 1.")
+    for key in ("style", "format", "diff_engine"):
+        if not isinstance(params[key], str):
+            raise ValueError("%s must be a string." % key)
+    for key in ("page_anchors", "region_only", "low_memory", "render"):
+        if not isinstance(params[key], bool):
+            raise ValueError("%s must be true or false." % key)
+
+    styles = params["style"].split(",")
+    if len(styles) != 2 or any(style not in ("box", "strike", "underline") for style in styles):
+        raise ValueError("Invalid style: %s." % params["style"])
+    if params["format"] not in CONTENT_TYPES:
+        raise ValueError("Invalid format: %s." % params["format"])
+    if params["diff_engine"] not in ("char", "word"):
+        raise ValueError("Invalid diff_engine: %s." % params["diff_engine"])
+    return params
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "pdf-diff"
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.send_json(200, self.server.service.status())
+        else:
+            self.send_json(404, { "error": "Not found." })
+
+    def do_POST(self):
+        kind = self.path.lstrip("/")
+        if kind not in REQUEST_KINDS:
+            self.send_json(404, { "error": "Not found." })
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            params = request_params(kind, body)
+        except ValueError as e: # including JSON errors
+            self.send_json(400, { "error": str(e) })
+            return
+
+        try:
+            status, content_type, data = self.server.service.run(kind, params, self.headers.get("X-Request-Id"))
+        except QueueFull:
+            self.send_json(503, { "error": "Too many requests are queued." }, { "Retry-After": "1" })
+            return
+        except Cancelled:
+            self.send_json(409, { "error": "The request was cancelled." })
+            return
+        except ValueError as e:
+            self.send_json(409, { "error": str(e) })
+            return
+        except Exception as e: # e.g. the request's process couldn't be started
+            self.send_json(500, { "error": "%s: %s" % (type(e).__name__, e) })
+            return
+        self.send_data(status, content_type, data)
+
+    def do_DELETE(self):
+        prefix = "/requests/"
+        if not self.path.startswith(prefix):
+            self.send_json(404, { "error": "Not found." })
+        elif self.server.service.cancel(self.path[len(prefix):]):
+            self.send_json(200, { "cancelled": self.path[len(prefix):] })
+        else:
+            self.send_json(404, { "error": "There is no request with that id." })
+
+    def send_json(self, status, value, headers={}):
+        self.send_data(status, "application/json", json.dumps(value).encode("utf8"), headers)
+
+    def send_data(self, status, content_type, data, headers={}):
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Clients of a Unix socket have no address.
+        return self.client_address[0] if self.client_address else "local"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None):
+    # Make an HTTP server for a DiffService listening on a host and port
+    # (port 0 picks a free port) or on a Unix socket.
+    if socket_path is not None:
+        remove_socket(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+def remove_socket(path):
+    # Remove the Unix socket at path, if any, e.g. one left by a server
+    # that didn't shut down cleanly. Raises FileExistsError if something
+    # other than a socket is there.
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise FileExistsError("%s exists and is not a socket." % path)
+    os.unlink(path)
+
+def main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='pdf-diff serve',
+        description='Runs a server that compares PDFs and renders their differences over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on (default 127.0.0.1)')
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int,
+                        help='port to listen on (default %d)' % DEFAULT_PORT)
+    parser.add_argument('--socket', metavar='path',
+                        help='listen on this Unix socket instead of a port')
+    parser.add_argument('-j', '--workers', metavar='N', default=os.cpu_count() or 1, type=int,
+                        help='number of requests to run at once (default: the number of CPUs)')
+    parser.add_argument('--queue-size', metavar='N', default=16, type=int,
+                        help='number of requests that may wait for a worker before more are refused (default 16)')
+    parser.add_argument('--cache-dir', metavar='dir',
+                        help='cache directory (default $PDF_DIFF_CACHE_DIR or ~/.cache/pdf-diff)')
+    args = parser.parse_args(argv)
+
+    if args.workers < 1 or args.queue_size < 0:
+        parser.error('--workers must be at least 1 and --queue-size at least 0.')
+
+    service = DiffService(args.workers, args.queue_size, DiskCache(args.cache_dir))
+    try:
+        server = make_server(service, args.host, args.port, args.socket)
+    except FileExistsError as e:
+        parser.error(str(e))
+    sys.stderr.write('Listening on %s.%s' % (args.socket or 'http://%s:%d' % server.server_address[0:2], os.linesep))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket:
+            try:
+                remove_socket(args.socket)
+            except FileExistsError:
+                pass # replaced by something else while the server ran
@@ -15,6 +15,9 @@ setup(name='pdf-diff',
           'lxml',
           'pillow',
       ],
+      extras_require={
+          'annotate': ['pypdf'],
+      },
       entry_points = {
         'console_scripts': ['pdf-diff=pdf_diff.command_line:main'],
       },
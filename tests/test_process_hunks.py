@@ -0,0 +1,83 @@
+# Checks that process_hunks, which bisects the box offsets, marks the
+# same boxes as the original implementation below, which popped boxes
+# off the front of lists of box dicts, on random documents and diffs.
+#
+#   python3 -m unittest discover tests
+
+import os, random, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.boxes import BoxStore
+from pdf_diff.command_line import expand_changes, normalize_boxes, process_hunks
+
+def reference_process_hunks(hunks, boxes):
+    offsets = [0, 0]
+    changes = []
+    for op, oplen in hunks:
+        if op == "=":
+            offsets[0] += oplen;
+            offsets[1] += oplen;
+            if len(changes) > 0 and changes[-1] != '*':
+                changes.append("*");
+        elif op in ("-", "+"):
+            idx = 0 if (op == "-") else 1
+            reference_mark_difference(oplen, offsets[idx], boxes[idx], changes)
+            offsets[idx] += oplen
+            idx2 = 1 - idx
+            reference_mark_difference(1, offsets[idx2]-1, boxes[idx2], changes)
+            reference_mark_difference(0, offsets[idx2]+0, boxes[idx2], changes)
+        else:
+            raise ValueError(op)
+    if len(changes) > 0 and changes[-1] == "*":
+        changes.pop()
+    return changes
+
+def reference_mark_difference(hunk_length, offset, boxes, changes):
+  while len(boxes) > 0 and (boxes[0]["startIndex"] + boxes[0]["textLength"]) <= offset:
+    boxes.pop(0)
+  while len(boxes) > 0 and boxes[0]["startIndex"] < offset + hunk_length:
+    changes.append(boxes.pop(0))
+
+def random_store(pdf_index, rng):
+    # Words of a few lengths, including a discretionary hyphen alone,
+    # whose normalized text is empty.
+    boxes = BoxStore(pdf_index, "random-%d.pdf" % pdf_index)
+    page = { "number": 1, "width": 612.0, "height": 792.0 }
+    for i in range(rng.randint(0, 40)):
+        text = rng.choice(["a", "bc", "defgh", "ij\u00AD", "\u00AD"])
+        boxes.append({ "index": i, "page": page, "x": 0.0, "y": float(i), "width": 10.0, "height": 1.0, "text": text })
+    normalize_boxes(boxes)
+    return boxes
+
+def random_hunks(length1, length2, rng):
+    # A diff of texts of the given lengths: runs of equal, deleted and
+    # inserted characters that consume both texts.
+    hunks = []
+    while length1 or length2:
+        op = rng.choice("=-+")
+        if op == "=" and length1 and length2:
+            n = rng.randint(1, min(length1, length2))
+            length1 -= n
+            length2 -= n
+        elif op == "-" and length1:
+            n = rng.randint(1, length1)
+            length1 -= n
+        elif op == "+" and length2:
+            n = rng.randint(1, length2)
+            length2 -= n
+        else:
+            continue
+        hunks.append((op, n))
+    return hunks
+
+class ProcessHunksTest(unittest.TestCase):
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for trial in range(500):
+            docs = [random_store(0, rng), random_store(1, rng)]
+            hunks = random_hunks(len(docs[0].text), len(docs[1].text), rng)
+            expected = reference_process_hunks(hunks, [list(docs[0]), list(docs[1])])
+            self.assertEqual(expand_changes(process_hunks(hunks, docs), docs), expected, hunks)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+# Checks that realign_pages, which finds the splits and groups of the
+# pages in linear time, splits the page images, relabels the changes and
+# groups the pages the same way as the original quadratic implementation
+# below, on random changes.
+#
+#   python3 -m unittest discover tests
+
+import copy, os, random, sys, unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pdf_diff.command_line import realign_pages
+
+def reference_realign_pages(pages, changes):
+    for pdf in (0, 1):
+        for page in list(pages[pdf]):
+            split_index = 0
+            pg = pages[pdf][page]
+            del pages[pdf][page]
+            pages[pdf][(page, split_index)] = pg
+            for box in changes:
+                if box != "*" and box["pdf"]["index"] == pdf and box["page"] == page:
+                    box["page"] = (page, 0)
+
+            for i, box in enumerate(changes):
+                if box != "*": continue
+                try:
+                    y1 = max(b["y"]+b["height"] for j, b in enumerate(changes)
+                        if j < i and b != "*" and b["pdf"]["index"] == pdf and b["page"] == (page, split_index))
+                    y2 = min(b["y"] for j, b in enumerate(changes)
+                        if j > i and b != "*" and b["pdf"]["index"] == pdf and b["page"] == (page, split_index))
+                except ValueError:
+                    continue
+                if y1+1 >= y2:
+                    continue
+
+                split_coord = int(round((y1+y2)/2))
+                im = pages[pdf][(page, split_index)]
+                pages[pdf][(page, split_index)] = im.crop([0, 0, im.size[0], split_coord ])
+                pages[pdf][(page, split_index+1)] = im.crop([0, split_coord, im.size[0], im.size[1] ])
+                for j, b in enumerate(changes):
+                    if j > i and b != "*" and b["pdf"]["index"] == pdf and b["page"] == (page, split_index):
+                        b["page"] = (page, split_index+1)
+                        b["y"] -= split_coord
+                split_index += 1
+
+    page_groups = [({}, {})]
+    for i, box in enumerate(changes):
+        if box != "*":
+            page_groups[-1][ box["pdf"]["index"] ][ box["page"] ] = pages[box["pdf"]["index"]][box["page"]]
+        else:
+            pages_before = set((b["pdf"]["index"], b["page"]) for j, b in enumerate(changes) if j < i and b != "*")
+            pages_after = set((b["pdf"]["index"], b["page"]) for j, b in enumerate(changes) if j > i and b != "*")
+            if len(pages_before & pages_after) == 0:
+                page_groups.append( ({}, {}) )
+    return page_groups
+
+def random_changes(rng):
+    # Changes in reading order on a few pages of each PDF, with markers
+    # between them, some overlapping the changes before them.
+    pdfs = [{ "index": 0 }, { "index": 1 }]
+    page_count = rng.randint(1, 4)
+    pages = [0, 0]
+    ys = [0.0, 0.0]
+    changes = []
+    for i in range(rng.randint(0, 40)):
+        if rng.random() < .3:
+            changes.append("*")
+            continue
+        pdf = rng.randint(0, 1)
+        if rng.random() < .1:
+            pages[pdf] += 1
+            ys[pdf] = 0.0
+        if rng.random() < .2:
+            ys[pdf] = rng.uniform(0, 300)
+        ys[pdf] += rng.choice([0, 0, rng.uniform(-5, 30)])
+        changes.append({ "pdf": pdfs[pdf], "page": pages[pdf] % page_count, "x": 1.0, "y": max(0, ys[pdf]) + rng.random(),
+                         "width": 3.0, "height": rng.uniform(1, 15) })
+    return changes
+
+def page_images(changes):
+    # An image for each page with changes, with each row a different
+    # shade so that the parts the pages are split into can be told apart.
+    pages = [{ }, { }]
+    for change in changes:
+        if change == "*": continue
+        im = Image.new("L", (2, 400))
+        im.putdata([y % 256 for y in range(400) for x in range(2)])
+        pages[change["pdf"]["index"]][change["page"]] = im
+    return pages
+
+def image_groups(page_groups):
+    return [[{ page: (im.size, im.tobytes()) for page, im in group[pdf].items() } for pdf in (0, 1)]
+            for group in page_groups]
+
+def change_positions(changes):
+    return [change if change == "*" else (change["pdf"]["index"], change["page"], change["y"]) for change in changes]
+
+class RealignPagesTest(unittest.TestCase):
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for trial in range(300):
+            changes = random_changes(rng)
+            expected_changes = copy.deepcopy(changes)
+            expected = reference_realign_pages(page_images(expected_changes), expected_changes)
+            page_groups = realign_pages(page_images(changes), changes)
+            self.assertEqual(change_positions(changes), change_positions(expected_changes), trial)
+            self.assertEqual(image_groups(page_groups), image_groups(expected), trial)
+
+if __name__ == "__main__":
+    unittest.main()